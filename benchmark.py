@@ -0,0 +1,735 @@
+#! /usr/bin/env python2.7
+# Import built in modules
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import StringIO
+import tempfile
+import time
+
+# Import third-part modules
+import cv2
+import numpy
+import tornado.httpclient
+import tornado.httpserver
+import tornado.gen
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+import tornado.web
+
+from PIL import Image
+from tornado.options import define, options
+
+# Import custom modules
+import server
+
+from files import files
+from opencv import opencv
+
+'''
+Micro benchmarks for the hot paths of the server.
+
+SYNOPSIS
+========
+
+::
+
+    benchmark.py [--repeat] [--images] [benchmark ...]
+
+DESCRIPTION
+===========
+
+This script time the functions the server runs for every request or every
+websocket frame and print the time per call. Without arguments every
+benchmark is run.
+
+OPTIONS
+=======
+
+``--repeat`` number of times each function is called, default is 200.
+
+``--images`` directory with the sample face images, default is
+    ``data/images``. Synthetic frames are used if it is empty.
+
+``--file-size`` size in megabytes of the file served by the ``serve`` and
+    ``sendfile`` benchmarks and uploaded by the ``upload`` one, default is
+    256.
+
+The options of ``server.py`` such as ``--read-buffer`` are accepted too.
+
+EXAMPLES
+========
+
+::
+    1. python2.7 benchmark.py
+    2. python2.7 benchmark.py --repeat 1000 decode
+
+'''
+
+define("repeat", default=200, help="number of calls per benchmark", type=int)
+define("images", default="data/images", help="directory with sample images")
+define("file_size", default=256, help="megabytes served by the serve and\
+        sendfile benchmarks and uploaded by the upload one", type=int)
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    Decorator to register a benchmark under the function name.
+    """
+
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timeit(func, *args):
+    """
+    A function to return the mean time per call in milliseconds.
+
+    Args:
+        func: function to call ``options.repeat`` times with ``args``.
+    """
+
+    func(*args) # warm up
+    start = time.time()
+    for i in xrange(options.repeat):
+        func(*args)
+    return (time.time() - start) * 1000 / options.repeat
+
+
+def report(name, elapsed, baseline=None, unit="ms"):
+    """
+    A function to print one benchmark result.
+    """
+
+    line = "%-40s %10.3f %s" % (name, elapsed, unit)
+    if baseline:
+        line += "  %6.2fx" % (baseline / elapsed)
+    print line
+
+
+def sample_frames(count=10, size=(320, 240)):
+    """
+    A function to return RGB frames of the size the browser clients send.
+
+    Args:
+        count: maximum number of frames.
+        size: width and height of the frames.
+    """
+
+    frames = []
+    for dirname, dirnames, filenames in os.walk(options.images):
+        for filename in sorted(filenames):
+            img = cv2.imread(os.path.join(dirname, filename))
+            if img is not None:
+                img = cv2.resize(img, size)
+                frames.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+            if len(frames) >= count:
+                return frames
+    if not frames:
+        logging.warning("No images in %s, using synthetic frames" %
+                        options.images)
+        noise = numpy.random.randint(0, 255, (size[1] / 8, size[0] / 8, 3))
+        frames.append(cv2.resize(noise.astype(numpy.uint8), size))
+    return frames
+
+
+def encode_jpeg(frame):
+    """
+    A function to encode an RGB frame like ``canvas.toBlob`` does.
+    """
+
+    ok, buf = cv2.imencode(".jpg", cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    return buf.tostring()
+
+
+def encode_raw(frame):
+    """
+    A function to encode an RGB frame as a raw grayscale websocket frame.
+    """
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    height, width = gray.shape
+    return opencv.RAW_FRAME_HEADER.pack(opencv.RAW_FRAME_MAGIC, width,
+                                        height) + gray.tostring()
+
+
+@benchmark
+def decode():
+    """
+    Compare the PIL decode path with ``opencv.decode_frame``.
+    """
+
+    message = encode_jpeg(sample_frames(1)[0])
+    raw = encode_raw(sample_frames(1)[0])
+
+    def pil(message):
+        image = Image.open(StringIO.StringIO(message))
+        return opencv.to_grayscale(numpy.array(image))
+
+    def fast(message):
+        return opencv.to_grayscale(opencv.decode_frame(message))
+
+    baseline = timeit(pil, message)
+    report("decode: PIL + StringIO", baseline)
+    report("decode: cv2.imdecode", timeit(fast, message), baseline)
+    report("decode: raw grayscale", timeit(fast, raw), baseline)
+
+
+@benchmark
+def track():
+    """
+    Compare a full-frame search of every frame with a FaceTracker.
+    """
+
+    frames = [frame for frame in sample_frames(20, (640, 480))
+              if len(opencv.detect_faces(frame))]
+    if not frames:
+        logging.warning("No face in the sample frames")
+        return
+    tracker = opencv.FaceTracker()
+
+    def full(frames):
+        return [opencv.detect_faces(frame) for frame in frames]
+
+    def tracked(frames):
+        return [tracker.detect(frame) for frame in frames]
+
+    baseline = timeit(full, frames) / len(frames)
+    report("track: full frame per frame", baseline)
+    report("track: tracker per frame", timeit(tracked, frames) / len(frames),
+           baseline)
+    print "track: %(full_searches)d full and %(roi_searches)d region " \
+          "searches, %(lost)d lost" % tracker.stats()
+
+
+def sample_images(count):
+    """
+    A function to return up to ``count`` sample images at their own size,
+    each is expected to show one face.
+    """
+
+    images = []
+    for dirname, dirnames, filenames in os.walk(options.images):
+        for filename in sorted(filenames):
+            img = cv2.imread(os.path.join(dirname, filename))
+            if img is not None:
+                images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+            if len(images) >= count:
+                return images
+    return images
+
+
+def cpu_time(func, *args):
+    """
+    A function to return the CPU seconds of every thread of the process
+    spent in one call.
+    """
+
+    before = os.times()
+    func(*args)
+    after = os.times()
+    return (after[0] - before[0]) + (after[1] - before[1])
+
+
+@benchmark
+def detector():
+    """
+    Frames per second per core and recall of every face detector backend on
+    the sample images, one at a time and in batches of 8.
+    """
+
+    images = sample_images(options.repeat)
+    if not images:
+        logging.warning("No images in %s" % options.images)
+        return
+    for name in opencv.detectors.names():
+        try:
+            opencv.detectors.get(name)
+        except IOError as e:
+            logging.warning("Skipping the %s detector: %s" % (name, e))
+            continue
+        found = []
+
+        def single():
+            found[:] = [opencv.detectors.detect(img, name) for img in images]
+
+        def batched():
+            for i in xrange(0, len(images), 8):
+                opencv.detectors.detect_batch(images[i:i + 8], name)
+
+        single()
+        elapsed = cpu_time(single)
+        recall = sum(1 for faces in found if len(faces)) / float(len(images))
+        report("detector: %s" % name, len(images) / max(elapsed, 0.01),
+               unit="frames/s per core")
+        report("detector: %s batches of 8" % name,
+               len(images) / max(cpu_time(batched), 0.01),
+               unit="frames/s per core")
+        print "detector: %s found a face in %d of %d images, recall %.3f" % (
+                name, int(round(recall * len(images))), len(images), recall)
+
+
+def overlap(a, b):
+    """
+    A function to return the intersection over union of two boxes.
+    """
+
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = float(width * height)
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+
+@benchmark
+def scale():
+    """
+    Latency and accuracy of the face detection at several detection scales
+    on 640x480 frames, against the full resolution search.
+    """
+
+    frames = sample_frames(50, (640, 480))
+    expected = [opencv.detect_faces(frame) for frame in frames]
+    with_face = sum(1 for faces in expected if len(faces))
+    if not with_face:
+        logging.warning("No face in the sample frames")
+
+    def search(frames, factor):
+        return [opencv.detect_faces(frame, factor) for frame in frames]
+
+    baseline = None
+    for factor in (1.0, 0.75, 0.5, 0.33, 0.25):
+        elapsed = timeit(search, frames, factor) / len(frames)
+        found = search(frames, factor)
+        recall = [overlap(e[0], f[0]) for e, f in zip(expected, found)
+                  if len(e) and len(f)]
+        report("scale: %.2f per frame" % factor, elapsed, baseline)
+        print "scale: %.2f found %d of %d faces, mean IoU %.3f" % (
+                factor, len(recall), with_face,
+                sum(recall) / len(recall) if recall else 0.0)
+        baseline = baseline or elapsed
+
+
+def legacy_crop_faces(img, faces):
+    """
+    The full-frame mask of ``opencv.crop_faces`` before it worked on the
+    face region only, kept to check that the output did not change.
+    """
+
+    for face in faces:
+        x, y, h, w = [result for result in face]
+        center = (x + w / 2, y + h / 2)
+        mask = numpy.zeros_like(img)
+        mask = cv2.ellipse(mask, center=center, axes=(h / 2, w / 2),
+                           angle=0, startAngle=0, endAngle=360,
+                           color=(255, 255, 255), thickness=-1)
+        images_ellipse = numpy.bitwise_and(img, mask)
+    return images_ellipse[y:y+h, x:x+w]
+
+
+@benchmark
+def preprocess():
+    """
+    Compare the full-frame crop, grayscale and resize of a face with
+    ``opencv.normalise_face`` and check that they give the same face.
+    """
+
+    frame = sample_frames(1, (640, 480))[0]
+    rng = numpy.random.RandomState(0)
+    for i in xrange(options.repeat):
+        size = rng.randint(30, 200, 2)
+        face = numpy.array([rng.randint(0, 640 - 20),
+                            rng.randint(0, 480 - 20), size[0],
+                            size[1] if i % 2 else size[0]])
+        for img in (frame, cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)):
+            expected = cv2.resize(opencv.to_grayscale(
+                    legacy_crop_faces(img, [face])), opencv.FACE_SIZE)
+            if not numpy.array_equal(expected,
+                                     opencv.normalise_face(img, face)):
+                raise AssertionError("normalise_face differs for %s" % face)
+    print "preprocess: %d random boxes identical" % options.repeat
+
+    face = numpy.array([280, 180, 120, 120])
+    out = numpy.empty(opencv.FACE_SIZE, numpy.uint8)
+
+    def legacy(frame):
+        return cv2.resize(opencv.to_grayscale(
+                legacy_crop_faces(frame, [face])), opencv.FACE_SIZE)
+
+    baseline = timeit(legacy, frame)
+    report("preprocess: full-frame mask", baseline)
+    report("preprocess: normalise_face", timeit(opencv.normalise_face,
+                                                frame, face), baseline)
+    report("preprocess: normalise_face into out",
+           timeit(opencv.normalise_face, frame, face, out), baseline)
+
+
+def synthetic_gallery(labels=40, per_label=10):
+    """
+    A function to return a random gallery of 100x100 faces and labels.
+    """
+
+    faces = [numpy.random.randint(0, 255, (100, 100)).astype(numpy.uint8)
+             for i in xrange(labels * per_label)]
+    return faces, numpy.repeat(numpy.arange(labels), per_label)
+
+
+@benchmark
+def predict():
+    """
+    Compare ``model.predict`` per face with batches of the SubspaceEngine.
+    """
+
+    faces, labels = synthetic_gallery()
+    model = opencv.create_recognizer()
+    model.train(faces, labels)
+    engine = opencv.SubspaceEngine(model)
+    probes = faces[:64]
+
+    def single(probes):
+        return [model.predict(face) for face in probes]
+
+    baseline = timeit(single, probes) / len(probes)
+    report("predict: model.predict per face", baseline)
+    for size in (1, 8, 64):
+        elapsed = timeit(engine.predict_batch, probes[:size]) / size
+        report("predict: engine batch of %d per face" % size, elapsed,
+               baseline)
+
+
+def clustered_gallery(labels, per_label, dimensions, rng):
+    """
+    A function to return the arrays of a subspace model whose projected
+    faces are grouped by label, the leading components spreading the labels
+    the most as in Fisherfaces, with faces near the gallery to probe it.
+    """
+
+    size = opencv.FACE_SIZE[0] * opencv.FACE_SIZE[1]
+    eigenvectors = numpy.linalg.qr(
+            rng.randn(size, dimensions))[0].astype(numpy.float32)
+    spread = numpy.linspace(4.0, 1.0, dimensions).astype(numpy.float32)
+    centres = rng.randn(labels, dimensions).astype(numpy.float32) * spread
+    gallery = (numpy.repeat(centres, per_label, axis=0) + 0.3 *
+               rng.randn(labels * per_label, dimensions)).astype(
+                       numpy.float32)
+    probes = centres[rng.randint(0, labels, 64)] + 0.3 * rng.randn(
+            64, dimensions)
+    faces = [eigenvectors.dot(probe).reshape(opencv.FACE_SIZE).astype(
+            numpy.float32) for probe in probes]
+    return (numpy.zeros(size, numpy.float32), eigenvectors, gallery,
+            numpy.repeat(numpy.arange(labels), per_label), faces)
+
+
+@benchmark
+def index():
+    """
+    Compare the time to predict a face with every face of the gallery, as
+    the SubspaceEngine and ``model.predict`` do, with the IdentityIndex as
+    the number of labels grows, and check that a trained model gives the
+    same labels with both when every label is a candidate, searched with
+    the tree or not and mapped back from a file.
+    """
+
+    faces, labels = synthetic_gallery()
+    model = opencv.create_recognizer()
+    model.train(faces, labels)
+    engine = opencv.SubspaceEngine(model)
+    path = tempfile.mktemp(dir=".")
+    opencv.IdentityIndex.from_model(model).save(path)
+    try:
+        identities = opencv.IdentityIndex.load(path)
+        probes = synthetic_gallery(8, 8)[0]
+        expected = engine.predict_batch(probes)
+        min_labels = opencv.INDEX_MIN_LABELS
+        for opencv.INDEX_MIN_LABELS in (min_labels, 0):
+            found = identities.query(probes, candidates=len(identities))
+            for (label, distance), nearest in zip(expected, found):
+                if (nearest[0][0] != label or
+                        abs(nearest[0][1] - distance) > 1e-3 * distance):
+                    raise AssertionError("index gives %s instead of %s" %
+                                         (nearest[0], (label, distance)))
+        opencv.INDEX_MIN_LABELS = min_labels
+    finally:
+        os.remove(path)
+    print "index: %d faces identical to the engine" % len(probes)
+
+    rng = numpy.random.RandomState(0)
+    for count in (100, 1000, 10000):
+        mean, eigenvectors, gallery, gallery_labels, probes = \
+                clustered_gallery(count, 5, 128, rng)
+        engine = opencv.SubspaceEngine.__new__(opencv.SubspaceEngine)
+        engine.mean, engine.eigenvectors = mean, eigenvectors
+        engine.gallery, engine.labels = gallery, gallery_labels
+        engine.gallery_norms = (gallery ** 2).sum(axis=1)
+        identities = opencv.IdentityIndex.build(mean, eigenvectors, gallery,
+                                                gallery_labels)
+        expected = [label for label, distance in
+                    engine.predict_batch(probes)]
+        agree = sum(nearest[0] == label for nearest, label in
+                    zip(identities.predict_batch(probes), expected))
+
+        def linear(probes):
+            return [engine.predict_batch([face]) for face in probes]
+
+        def indexed(probes):
+            return [identities.query([face], k=5) for face in probes]
+
+        baseline = timeit(linear, probes) / len(probes)
+        report("index: %d labels, every face" % count, baseline)
+        report("index: %d labels, top 5 of the index" % count,
+               timeit(indexed, probes) / len(probes), baseline)
+        print "index: %d labels, same label for %d of %d faces" % (
+                count, agree, len(probes))
+
+
+def fetch_throughput(url, headers=None):
+    """
+    A function to download ``url`` from a server on the current IOLoop and
+    return the throughput in megabytes per second.
+    """
+
+    received = [0]
+
+    def on_chunk(chunk):
+        received[0] += len(chunk)
+
+    client = tornado.httpclient.AsyncHTTPClient()
+    request = tornado.httpclient.HTTPRequest(url, headers=headers,
+                                             streaming_callback=on_chunk,
+                                             request_timeout=600)
+    start = time.time()
+    tornado.ioloop.IOLoop.current().run_sync(lambda: client.fetch(request))
+    return received[0] / (time.time() - start) / (1 << 20)
+
+
+@benchmark
+def serve():
+    """
+    Throughput of ServerFilesHandler streaming a file over HTTP with
+    different read buffer sizes, and of a multi-range request.
+    """
+
+    directory = tempfile.mkdtemp(dir=".")
+    files_root, options.files_root = options.files_root, directory
+    try:
+        path = "video.bin"
+        with open(os.path.join(directory, path), "wb") as f:
+            block = os.urandom(1 << 20)
+            for i in xrange(options.file_size):
+                f.write(block)
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        http_server = tornado.httpserver.HTTPServer(server.Application())
+        http_server.add_sockets(sockets)
+        url = "http://127.0.0.1:%d/%s" % (sockets[0].getsockname()[1], path)
+        read_buffer = options.read_buffer
+        for size in (16 << 10, 64 << 10, 256 << 10, 1 << 20):
+            options.read_buffer = size
+            report("serve: %d KB buffer" % (size >> 10),
+                   fetch_throughput(url), unit="MB/s")
+        options.read_buffer = read_buffer
+        last = options.file_size << 20
+        ranges = ",".join("%d-%d" % (start, start + (1 << 20) - 1)
+                          for start in xrange(0, last, last / 8))
+        report("serve: 8 ranges of 1 MB",
+               fetch_throughput(url, {"Range": "bytes=" + ranges}),
+               unit="MB/s")
+        http_server.stop()
+    finally:
+        shutil.rmtree(directory)
+        options.files_root = files_root
+
+
+def drain(port, path, repeat):
+    """
+    A function to download a file ``repeat`` times with a raw socket and
+    throw the bytes away, it runs in a child process so that its CPU time is
+    not counted against the server.
+    """
+
+    for i in xrange(repeat):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall("GET /%s HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                     "Connection: close\r\n\r\n" % path)
+        while sock.recv(1 << 20):
+            pass
+        sock.close()
+
+
+@benchmark
+def sendfile():
+    """
+    CPU time the server spends per gigabyte sent when it reads the file in
+    python, as over TLS, and when it lets the kernel copy it with
+    ``sendfile``.
+    """
+
+    directory = tempfile.mkdtemp(dir=".")
+    files_root, options.files_root = options.files_root, directory
+    try:
+        path = "video.bin"
+        with open(os.path.join(directory, path), "wb") as f:
+            block = os.urandom(1 << 20)
+            for i in xrange(options.file_size):
+                f.write(block)
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        http_server = tornado.httpserver.HTTPServer(server.Application())
+        http_server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        io_loop = tornado.ioloop.IOLoop.current()
+        min_size = options.sendfile_min_size
+        can_sendfile = server.ServerFilesHandler.can_sendfile
+        modes = [("read", 0, can_sendfile)]
+        if files.sendfile is not None:
+            modes.append(("sendfile", 1, can_sendfile))
+        else:
+            logging.warning("No sendfile, install pysendfile on python 2.7")
+        repeat = 4
+        gigabytes = repeat * options.file_size / 1024.0
+        baseline = None
+        for name, size, check in modes:
+            options.sendfile_min_size = size
+            server.ServerFilesHandler.can_sendfile = check
+            client = multiprocessing.Process(target=drain,
+                                             args=(port, path, repeat))
+            before, start = os.times(), time.time()
+            client.start()
+            while client.is_alive():
+                io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+            after, elapsed = os.times(), time.time() - start
+            cpu = (after[0] - before[0]) + (after[1] - before[1])
+            report("sendfile: %s CPU per GB" % name, cpu / gigabytes,
+                   baseline, unit="s")
+            report("sendfile: %s throughput" % name,
+                   gigabytes * 1024 / elapsed, unit="MB/s")
+            baseline = baseline or cpu / gigabytes
+        options.sendfile_min_size = min_size
+        server.ServerFilesHandler.can_sendfile = can_sendfile
+        http_server.stop()
+    finally:
+        shutil.rmtree(directory)
+        options.files_root = files_root
+
+
+def put_piece(port, path, cookie, block, start, end, size, cut=None):
+    """
+    A function to upload the bytes ``start`` to ``end`` of a file made of
+    ``block`` repeated, and to drop the connection after ``cut`` bytes to
+    simulate a broken link. Returns the reply, ``None`` when cut.
+    """
+
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall("PUT /upload/%s HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                 "Cookie: user=%s\r\nContent-Length: %d\r\n"
+                 "Content-Range: bytes %d-%d/%d\r\n"
+                 "Connection: close\r\n\r\n" %
+                 (path, cookie, end - start, start, end - 1, size))
+    position = start
+    stop = end if cut is None else start + cut
+    while position < stop:
+        offset = position % len(block)
+        chunk = block[offset:offset + stop - position]
+        sock.sendall(chunk)
+        position += len(chunk)
+    if cut is not None:
+        sock.close()
+        return None
+    reply = ""
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    return reply
+
+
+def feed(port, path, cookie, block, size, piece):
+    """
+    A function to upload a file in pieces of ``piece`` bytes, the first
+    piece is cut halfway and resumed from the offset the server returns. It
+    runs in a child process so that the server memory is measured alone.
+    """
+
+    put_piece(port, path, cookie, block, 0, piece, size, cut=piece / 2)
+    time.sleep(0.2)
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall("GET /upload/%s HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                 "Cookie: user=%s\r\nConnection: close\r\n\r\n" %
+                 (path, cookie))
+    reply = ""
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    start = int(reply.split("Upload-Offset: ")[1].split("\r\n")[0])
+    while start < size:
+        end = min(start + piece, size)
+        put_piece(port, path, cookie, block, start, end, size)
+        start = end
+
+
+@benchmark
+def upload():
+    """
+    Throughput and memory of the server receiving a file of ``file_size``
+    megabytes in pieces of a quarter of it through UploadHandler, with an
+    interrupted piece resumed, and check the file received.
+    """
+
+    root = options.upload_root
+    options.upload_root = tempfile.mkdtemp(dir=".")
+    try:
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        application = server.Application()
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        io_loop = tornado.ioloop.IOLoop.current()
+        cookie = tornado.web.create_signed_value(
+                application.settings["cookie_secret"], "user", "admin")
+        block = os.urandom(1 << 20)
+        size = options.file_size << 20
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        client = multiprocessing.Process(
+                target=feed, args=(port, "bench/video.bin", cookie, block,
+                                   size, size / 4))
+        start = time.time()
+        client.start()
+        while client.is_alive():
+            io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+        elapsed = time.time() - start
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+        path = os.path.join(options.upload_root, "bench", "video.bin")
+        with open(path, "rb") as f:
+            for i in xrange(options.file_size):
+                if f.read(1 << 20) != block:
+                    raise AssertionError("uploaded file differs at %d MB" % i)
+        report("upload: throughput", options.file_size / elapsed,
+               unit="MB/s")
+        report("upload: server memory growth", growth / 1024.0, unit="MB")
+        http_server.stop()
+    finally:
+        shutil.rmtree(options.upload_root)
+        options.upload_root = root
+
+
+def main():
+    """
+    Run the benchmarks named on the command line, or all of them.
+    """
+
+    names = tornado.options.parse_command_line() or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ CREATE TABLE label
   name varchar(255)
 );
 
+CREATE INDEX label_name ON label (name);
+
 CREATE TABLE image
 (
   id INTEGER PRIMARY KEY,
@@ -11,3 +13,17 @@ CREATE TABLE image
   label_id INTEGER,
   FOREIGN KEY(label_id) REFERENCES label(id)
 );
+
+CREATE INDEX image_label_id ON image (label_id);
+
+CREATE TABLE training
+(
+  id INTEGER PRIMARY KEY,
+  version INTEGER,
+  recognizer varchar(255),
+  mode varchar(255),
+  last_image INTEGER,
+  images INTEGER,
+  duration REAL,
+  created DATETIME
+);
@@ -0,0 +1,788 @@
+# Built in modules
+import collections
+import email.utils
+import errno
+import fcntl
+import logging
+import mimetypes
+import os
+import uuid
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # backport for python 2.7
+    except ImportError:
+        scandir = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile # pysendfile for python 2.7
+    except ImportError:
+        sendfile = None
+
+'''
+Helpers for serving the files that recides within the server.
+
+DESCRIPTION
+===========
+
+This module implement the parts of HTTP that the tornado file handlers need
+to serve large files: validators for conditional requests and byte ranges,
+content negotiation of compressed files, a cache of the directory listings
+and a cache of the small files. Files are uploaded into the tree in resumable
+pieces.
+
+'''
+
+MAX_RANGES = 32
+# Precompressed siblings of a file in order of preference
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE_TYPES = set(["application/javascript", "application/json",
+                          "application/x-javascript", "application/xml",
+                          "image/svg+xml"])
+GZIP_LEVEL = 6
+# smaller files grow or barely shrink once compressed
+MIN_COMPRESS_SIZE = 1024
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    Raised when none of the requested byte ranges overlaps the file.
+    """
+
+
+class UploadConflict(Exception):
+    """
+    Raised when an upload can not go on at the requested offset, or another
+    request is writing the same file. ``offset`` is the number of bytes
+    already received.
+    """
+
+    def __init__(self, offset):
+        Exception.__init__(self, offset)
+        self.offset = offset
+
+
+def etag(stat, suffix=""):
+    """
+    A function to return a strong entity tag for a file.
+
+    Args:
+        stat: ``os.stat`` result of the file.
+        suffix: appended to tell the encoded copies of the file apart.
+    """
+
+    return '"%x-%x-%x%s"' % (stat.st_ino, stat.st_size,
+                             int(stat.st_mtime * 1000), suffix)
+
+
+def compressible(content_type):
+    """
+    A function to check whether a content type is worth compressing.
+    """
+
+    return content_type.startswith("text/") or \
+        content_type in COMPRESSIBLE_TYPES
+
+
+def gzip_bytes(data, level=GZIP_LEVEL):
+    """
+    A function to compress bytes in the gzip format.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepted_encodings(header):
+    """
+    A function to return the content codings allowed by an
+    ``Accept-Encoding`` header, codings with ``q=0`` are left out.
+    """
+
+    accepted = set()
+    for item in header.split(","):
+        coding, sep, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, sep, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0 and coding.strip():
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def parse_http_date(value):
+    """
+    A function to convert an HTTP date to a unix timestamp, ``None`` if it
+    can not be parsed.
+    """
+
+    parsed = email.utils.parsedate_tz(value or "")
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def etag_matches(header, tag):
+    """
+    A function to check whether an ``If-None-Match`` or ``If-Match`` header
+    contains the entity tag, using the weak comparison.
+    """
+
+    if header.strip() == "*":
+        return True
+    tag = tag[2:] if tag.startswith("W/") else tag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def not_modified(headers, tag, mtime):
+    """
+    A function to check whether a conditional GET can be answered with 304.
+
+    Args:
+        headers: request headers.
+        tag: entity tag of the file.
+        mtime: modification time of the file.
+    """
+
+    if "If-None-Match" in headers:
+        return etag_matches(headers["If-None-Match"], tag)
+    since = parse_http_date(headers.get("If-Modified-Since"))
+    return since is not None and int(mtime) <= since
+
+
+def if_range(headers, tag, mtime):
+    """
+    A function to check whether the ``Range`` header applies, i.e. the
+    ``If-Range`` validator, if any, still matches the file.
+    """
+
+    value = headers.get("If-Range")
+    if value is None:
+        return True
+    if value.startswith('"') or value.startswith("W/"):
+        return value == tag
+    return parse_http_date(value) == int(mtime)
+
+
+def parse_range(header, size):
+    """
+    A function to parse a ``Range`` header.
+
+    Args:
+        header: value of the ``Range`` header.
+        size: size of the file.
+
+    Returns:
+        list of (start, end) tuples with ``end`` exclusive, overlapping
+        ranges are merged. ``None`` if the header is invalid or asks for too
+        many ranges, the whole file should be served then.
+
+    Raises:
+        RangeNotSatisfiable: no range overlaps the file.
+    """
+
+    unit, sep, specs = header.partition("=")
+    if unit.strip() != "bytes" or not sep:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        start, sep, end = spec.strip().partition("-")
+        try:
+            if not start:
+                # suffix range, the last ``end`` bytes
+                length = int(end)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size
+            else:
+                start = int(start)
+                end = int(end) + 1 if end else None
+        except ValueError:
+            return None
+        if not sep or start < 0 or (end is not None and end <= start):
+            return None
+        if start < size:
+            ranges.append((start, size if end is None else min(end, size)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def parse_content_range(header):
+    """
+    A function to parse the ``Content-Range`` header of an uploaded piece.
+
+    Args:
+        header: value of the header, e.g. ``bytes 0-1023/4096``.
+
+    Returns:
+        (start, end, size) tuple with ``end`` exclusive, ``None`` if the
+        header is invalid.
+    """
+
+    unit, sep, spec = header.strip().partition(" ")
+    span, sep, size = spec.partition("/")
+    start, dash, end = span.partition("-")
+    if unit != "bytes" or not sep or not dash:
+        return None
+    try:
+        start, end, size = int(start), int(end) + 1, int(size)
+    except ValueError:
+        return None
+    if start < 0 or end <= start or end > size:
+        return None
+    return start, end, size
+
+
+def multipart_ranges(ranges, size, content_type):
+    """
+    A function to lay out a ``multipart/byteranges`` body.
+
+    Args:
+        ranges: list of (start, end) tuples.
+        size: size of the file.
+        content_type: content type of the file.
+
+    Returns:
+        boundary: boundary of the parts.
+        parts: list of (header, start, end) tuples, the header is written
+            before the bytes of the range.
+        trailer: bytes written after the last part.
+    """
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, end in ranges:
+        header = ("\r\n--%s\r\nContent-Type: %s\r\n"
+                  "Content-Range: bytes %d-%d/%d\r\n\r\n" %
+                  (boundary, content_type, start, end - 1, size))
+        parts.append((header, start, end))
+    return boundary, parts, "\r\n--%s--\r\n" % boundary
+
+
+def read_chunks(f, start, end, buffer_size):
+    """
+    A generator to read the bytes ``start`` to ``end`` of a file.
+
+    Args:
+        f: file opened in binary mode.
+        start: first byte.
+        end: byte after the last one.
+        buffer_size: maximum size of a chunk.
+    """
+
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = f.read(min(buffer_size, remaining))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def resolve_path(root, path):
+    """
+    A function to map an url path to a file under ``root``.
+
+    Args:
+        root: directory the url paths are relative to.
+        path: url path, without the leading slash.
+
+    Returns:
+        real path of the file, ``None`` if a component of ``path`` is
+        hidden or the path leaves ``root`` through ``..``, an absolute path
+        or a symbolic link.
+    """
+
+    if any(part.startswith(".") for part in path.split("/")):
+        return None
+    root = os.path.realpath(root)
+    target = os.path.realpath(os.path.join(root, path))
+    if target != root and not target.startswith(root + os.sep):
+        return None
+    return target
+
+
+def scan_directory(path):
+    """
+    A function to list a directory as (name, is_dir) tuples. ``scandir``
+    gets the type of the entries with the names, ``os.listdir`` needs one
+    ``stat`` per entry.
+
+    Args:
+        path: directory to list.
+    """
+
+    if scandir is not None:
+        return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+    return [(name, os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def stat_entry(path, name):
+    """
+    A function to return the size and mtime of a directory entry, zeros if
+    it was removed in the meantime.
+    """
+
+    try:
+        stat = os.stat(os.path.join(path, name))
+    except OSError:
+        return 0, 0
+    return stat.st_size, stat.st_mtime
+
+
+class DirectoryCache(object):
+    """
+    Cache of the directory listings.
+
+    A listing is scanned again when the mtime of the directory changes,
+    i.e. an entry was added, removed or renamed. Sorted listings are kept
+    with the scan, sizes and mtimes used to sort by ``size`` or ``mtime``
+    are refreshed with it. The least recently used directories are evicted
+    beyond ``max_entries``.
+    """
+
+    SORT_KEYS = ('name', 'size', 'mtime')
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, path, sort='name', reverse=False):
+        """
+        A method to return the sorted (name, is_dir) entries of a directory.
+
+        Args:
+            path: directory to list.
+            sort: one of ``SORT_KEYS``.
+            reverse: sort in descending order.
+        """
+
+        entry = self._entry(path)
+        key = (sort, reverse)
+        if key not in entry['sorted']:
+            entries = entry['entries']
+            if sort == 'name':
+                entries = sorted(entries, reverse=reverse)
+            else:
+                index = self.SORT_KEYS.index(sort) - 1
+                stats = dict((name, stat_entry(path, name))
+                             for name, is_dir in entries)
+                entries = sorted(entries, reverse=reverse,
+                                 key=lambda item: (stats[item[0]][index],
+                                                   item[0]))
+            entry['sorted'][key] = entries
+        return entry['sorted'][key]
+
+    def find(self, path, names):
+        """
+        A method to return the first of ``names`` that is a file in a
+        directory, ``None`` if there is none.
+
+        Args:
+            path: directory to search.
+            names: candidate file names, e.g. index pages.
+        """
+
+        entry = self._entry(path)
+        if 'files' not in entry:
+            entry['files'] = set(name for name, is_dir in entry['entries']
+                                 if not is_dir)
+        for name in names:
+            if name in entry['files']:
+                return name
+        return None
+
+    def _entry(self, path):
+        path = os.path.normpath(path)
+        mtime = os.stat(path).st_mtime
+        entry = self._entries.pop(path, None)
+        if entry is None or entry['mtime'] != mtime:
+            self.misses += 1
+            entry = {'mtime': mtime, 'entries': scan_directory(path),
+                     'sorted': {}}
+        else:
+            self.hits += 1
+        self._entries[path] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        """
+        A method to return the number of cached directories, hits and misses.
+        """
+
+        return {'directories': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+
+CachedFile = collections.namedtuple("CachedFile", ["body", "content_type",
+                                                   "etag", "stat"])
+
+
+class ContentCache(object):
+    """
+    In-memory cache of the small files served most often.
+
+    Files up to ``max_file_size`` bytes are kept with their content type and
+    entity tag, the least recently used files are evicted once the bodies
+    take more than ``max_bytes``. An entry is used only while the ``stat``
+    of the file still has the same inode, size and mtime.
+
+    With ``encoding`` set to ``gzip`` the cache holds the compressed bodies
+    of the compressible files instead. ``read`` can then run on a worker
+    thread, the files being compressed are kept in ``pending``.
+    """
+
+    def __init__(self, max_bytes, max_file_size, encoding=None):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.encoding = encoding
+        self.pending = set()
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, path, stat):
+        """
+        A method to check whether a file is small enough for the cache and,
+        for an encoding cache, compressible and at least
+        ``MIN_COMPRESS_SIZE`` bytes.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+        """
+
+        if stat.st_size > self.max_file_size or \
+                stat.st_size > self.max_bytes:
+            return False
+        if self.encoding and stat.st_size < MIN_COMPRESS_SIZE:
+            return False
+        mime_type, encoding = mimetypes.guess_type(path)
+        return not self.encoding or compressible(mime_type or 'text/plain')
+
+    def lookup(self, path, stat):
+        """
+        A method to return the CachedFile of a file if it is cached and
+        still matches ``stat``, ``None`` otherwise.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+        """
+
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+            if (entry.stat.st_ino, entry.stat.st_size,
+                    entry.stat.st_mtime) != (stat.st_ino, stat.st_size,
+                                             stat.st_mtime):
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[path] = entry
+        self.size += len(entry.body)
+        return entry
+
+    def read(self, path, stat):
+        """
+        A method to read, and compress for an encoding cache, a file into a
+        CachedFile without adding it to the cache. It touches no state of
+        the cache so it can run on a worker thread. ``None`` if the file
+        changed while it was read.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+        """
+
+        mime_type, encoding = mimetypes.guess_type(path)
+        content_type = mime_type or 'text/plain'
+        with open(path, 'rb') as f:
+            body = f.read(stat.st_size)
+        if len(body) != stat.st_size:
+            return None
+        suffix = ""
+        if self.encoding == "gzip":
+            body = gzip_bytes(body)
+            suffix = "-gzip"
+        return CachedFile(body, content_type, etag(stat, suffix), stat)
+
+    def add(self, path, entry):
+        """
+        A method to add a CachedFile read by ``read`` and evict the least
+        recently used files over ``max_bytes``.
+        """
+
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        self._entries[path] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            evicted_path, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def get(self, path, stat):
+        """
+        A method to return the CachedFile of a file, reading it on a miss.
+        ``None`` if the file is too large to be cached.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+        """
+
+        if not self.cacheable(path, stat):
+            return None
+        entry = self.lookup(path, stat)
+        if entry is None:
+            entry = self.read(path, stat)
+            if entry is not None:
+                self.add(path, entry)
+        return entry
+
+    def stats(self):
+        """
+        A method to return the hit, miss and eviction counters.
+        """
+
+        return {'files': len(self._entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def precompress(root, min_size=MIN_COMPRESS_SIZE):
+    """
+    A function to write the ``.gz`` and, when the ``brotli`` module is
+    installed, ``.br`` siblings of the compressible files in a directory
+    tree. Siblings that are older than their file are written again.
+
+    Args:
+        root: directory to walk.
+        min_size: smaller files are not worth compressing.
+
+    Returns:
+        number of siblings written.
+    """
+
+    encoders = [(".gz", lambda data: gzip_bytes(data, 9))]
+    if brotli is not None:
+        encoders.append((".br", brotli.compress))
+    suffixes = tuple(suffix for encoding, suffix in PRECOMPRESSED)
+    written = 0
+    for dirname, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            mime_type, encoding = mimetypes.guess_type(path)
+            if filename.endswith(suffixes) or encoding is not None or \
+                    not compressible(mime_type or ""):
+                continue
+            stat = os.stat(path)
+            if stat.st_size < min_size:
+                continue
+            data = None
+            for suffix, encode in encoders:
+                target = path + suffix
+                if os.path.exists(target) and \
+                        os.stat(target).st_mtime >= stat.st_mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                tmp = target + ".tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(encode(data))
+                os.rename(tmp, target)
+                written += 1
+                logging.info("Compressed %s" % target)
+    return written
+
+
+class Upload(object):
+    """
+    A file uploaded in pieces, possibly by several requests.
+
+    The bytes are written to a hidden partial file next to the destination,
+    named after the total size announced by the first piece, ``upload``
+    when a file is sent whole. The partial file outlives an interrupted
+    request, so the next request resumes at its size instead of starting
+    over, and a piece announcing another total is refused. Once the upload
+    is complete the partial file replaces the destination with an atomic
+    rename, readers never see a half-written file. A lock on the partial
+    file lets one request write it at a time, across processes too.
+    """
+
+    WHOLE = "upload"
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = None
+        self.file = None
+        self.offset = 0
+
+    def _part_path(self, size):
+        dirname, name = os.path.split(self.path)
+        return os.path.join(dirname, ".%s.%s.part" %
+                            (name, self.WHOLE if size is None else size))
+
+    def partial(self):
+        """
+        A method to find the partial file of the upload.
+
+        Returns:
+            (path, size) of the partial file, ``size`` is the total of the
+            first piece or ``None`` for a file sent whole. ``None`` if there
+            is no partial file.
+        """
+
+        dirname, name = os.path.split(self.path)
+        prefix = ".%s." % name
+        try:
+            entries = os.listdir(dirname or os.curdir)
+        except OSError:
+            return None
+        for entry in entries:
+            if not (entry.startswith(prefix) and entry.endswith(".part")):
+                continue
+            size = entry[len(prefix):-len(".part")]
+            if size == self.WHOLE:
+                return os.path.join(dirname, entry), None
+            if size.isdigit():
+                return os.path.join(dirname, entry), int(size)
+        return None
+
+    def received(self):
+        """
+        A method to return the number of bytes received so far.
+        """
+
+        partial = self.partial()
+        try:
+            return os.path.getsize(partial[0]) if partial else 0
+        except OSError:
+            return 0
+
+    def _lock(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        f = os.fdopen(fd, 'r+b')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise UploadConflict(self.received())
+        return f
+
+    def open(self, start, size=None):
+        """
+        A method to lock the partial file and go on writing it at ``start``,
+        the bytes after it are dropped. A first piece, at 0, replaces a
+        partial file with another total.
+
+        Args:
+            start: offset of the next piece, at most the bytes received.
+            size: total size of the file, ``None`` for a file sent whole.
+
+        Raises:
+            UploadConflict: ``start`` is after the bytes received, ``size``
+                is not the total of the first piece, or another request is
+                writing the file.
+        """
+
+        partial = self.partial()
+        if partial is not None and partial[1] != size:
+            if start > 0:
+                raise UploadConflict(self.received())
+            f = self._lock(partial[0])
+            os.remove(partial[0])
+            f.close()
+            partial = None
+        if start > 0 and partial is None:
+            raise UploadConflict(0)
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.part_path = self._part_path(size)
+        f = self._lock(self.part_path)
+        received = os.fstat(f.fileno()).st_size
+        if start > received:
+            f.close()
+            raise UploadConflict(received)
+        f.truncate(start)
+        f.seek(start)
+        self.file = f
+        self.offset = start
+
+    def write(self, chunk):
+        """
+        A method to append a chunk at the current offset.
+        """
+
+        self.file.write(chunk)
+        self.offset += len(chunk)
+
+    def commit(self):
+        """
+        A method to flush the partial file to disk and rename it over the
+        destination.
+        """
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        os.rename(self.part_path, self.path)
+        self.close()
+
+    def close(self):
+        """
+        A method to release the partial file, the bytes written are kept for
+        the next request.
+        """
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,15 +1,32 @@
 # Built in modules
+import cPickle
+import datetime
+import fcntl
+import hashlib
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
+import Queue
 import shutil
+import struct
 import sys
+import threading
+import time
 
 # Third-part modules
 import cv2
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from peewee import *
 
+try:
+    from sklearn.neighbors import KDTree
+except ImportError:
+    KDTree = None
+
 '''
 Opencv operations for detect, predict and crop the images.
 
@@ -23,13 +40,334 @@ authentication purposes.
 Files
 =====
 write a file , ``model.mdl``
+write the arrays of the numpy engine in ``model.engine``
+write the centroids of the identity index in ``model.index``
 create database file, ``data/images.db``
+cache the normalised faces and their index in ``data/faces.cache``
 
 
 '''
 
 MODEL_FILE = "model.mdl"
-db = SqliteDatabase("data/images.db")
+ENGINE_FILE = "model.engine" # memory mapped by every server process
+INDEX_FILE = "model.index" # centroids of the IdentityIndex
+PREDICT_ENGINE = "opencv" # or "numpy" for the batched SubspaceEngine, or
+                          # "index" for the IdentityIndex
+INDEX_CANDIDATES = 8 # labels of the nearest centroids compared with a face
+INDEX_DIMENSIONS = 32 # leading subspace components searched by the KD-tree
+INDEX_MIN_LABELS = 500 # fewer labels are all compared, the tree is slower
+RECOGNIZER = "fisher" # or "lbph" for incremental training
+CASCADE_FILE = "data/haarcascade_frontalface_alt.xml"
+# from the data/lbpcascades directory of the OpenCV sources
+LBP_CASCADE_FILE = "data/lbpcascade_frontalface.xml"
+# the res10 SSD face detector of the OpenCV samples/dnn/face_detector
+DNN_CONFIG_FILE = "data/deploy.prototxt"
+DNN_WEIGHTS_FILE = "data/res10_300x300_ssd_iter_140000.caffemodel"
+DETECTOR = "haar" # or "lbp" or "dnn"
+FACE_CACHE_FILE = "data/faces.cache"
+FACE_SIZE = (100, 100)
+DETECT_MIN_SIZE = (30, 30) # smallest face searched, in frame pixels
+TRACK_FULL_EVERY = 10 # frames between two full-frame searches of a tracker
+TRACK_PADDING = 0.5 # margin around the last face searched by a tracker
+TRACK_SMOOTHING = 0.5 # weight of the newest box in the tracked box
+IDENTITY_MAX_FRAMES = 15 # frames an identity is reused before a new predict
+IDENTITY_MAX_DISTANCE = 0 # largest distance of a reused identity, 0 any
+IDENTITY_CONFIRMATIONS = 2 # same identity predicted before it is reused
+IDENTITY_MAX_SHIFT = 0.25 # box movement that forces a predict, in widths
+IDENTITY_MAX_CHANGE = 20.0 # mean gray level change that forces a predict
+MASK_CACHE_SIZE = 256 # elliptical face masks kept by size
+HARVEST_IMAGES = 10 # faces saved per label at enrolment
+HARVEST_CANDIDATES = 30 # frames with a face scored before saving the best
+RAW_FRAME_MAGIC = "GRAY"
+RAW_FRAME_HEADER = struct.Struct("<4sHH")
+DB_FILE = "data/images.db"
+# WAL lets the worker threads read while one of them writes, busy_timeout
+# makes a writer wait for the other one instead of failing
+DB_PRAGMAS = [("journal_mode", "wal"), ("synchronous", "normal"),
+              ("busy_timeout", 5000), ("cache_size", -8000),
+              ("temp_store", "memory")]
+# every thread opens one connection on its first query and keeps it
+db = SqliteDatabase(DB_FILE, pragmas=DB_PRAGMAS, threadlocals=True)
+
+
+class LatencyStats(object):
+    """
+    Thread safe counter for the number of calls and the time they took.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        """
+        A method to record the duration of one call.
+
+        Args:
+            elapsed: duration of the call in seconds.
+        """
+        with self._lock:
+            self.count += 1
+            self.total += elapsed
+            self.max = max(self.max, elapsed)
+
+    def as_dict(self):
+        """
+        A method to return the counters in milliseconds.
+        """
+        with self._lock:
+            mean = self.total / self.count if self.count else 0.0
+            return {'count': self.count,
+                    'mean_ms': round(mean * 1000, 3),
+                    'max_ms': round(self.max * 1000, 3)}
+
+
+class CascadeDetector(object):
+    """
+    Face detector backend for the Haar and LBP cascade classifiers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        A method to load a new instance of the classifier.
+        """
+        cascade = cv2.CascadeClassifier(self.path)
+        if cascade.empty():
+            raise IOError("Unable to load cascade %s" % self.path)
+        return cascade
+
+    def detect(self, cascade, img, scale=1.0):
+        """
+        A method to detect the biggest face of a frame.
+
+        Args:
+            cascade: instance returned by ``load``.
+            img: RGB or grayscale frame.
+            scale: factor the frame is shrunk by for the search.
+        """
+        return detect(img, cascade, scale)
+
+    def detect_batch(self, cascade, images, scale=1.0):
+        """
+        A method to detect the faces of several frames, one at a time.
+        """
+        return [detect(img, cascade, scale) for img in images]
+
+
+class DnnDetector(object):
+    """
+    Face detector backend for the SSD network of the OpenCV DNN module run
+    on the CPU.
+
+    The frames are resized to the 300x300 input of the network, so the
+    detection scale is ignored, and a batch of frames is classified with
+    one forward pass. The biggest face above ``confidence`` is returned, as
+    the cascades do. The network and ``blobFromImages`` need OpenCV 3.3 or
+    newer, ``load`` fails on older versions such as the 3.2 the face
+    recognizers are written for.
+    """
+
+    SIZE = (300, 300)
+    MEAN = (104.0, 177.0, 123.0)
+
+    def __init__(self, config, weights, confidence=0.5):
+        self.config = config
+        self.weights = weights
+        self.confidence = confidence
+
+    def load(self):
+        """
+        A method to load a new instance of the network.
+        """
+        dnn = getattr(cv2, "dnn", None)
+        if not (hasattr(dnn, "blobFromImages") and
+                hasattr(dnn, "readNetFromCaffe")):
+            raise IOError("The dnn detector needs OpenCV 3.3 or newer with "
+                          "the dnn module, found %s" % cv2.__version__)
+        for path in (self.config, self.weights):
+            if not os.path.exists(path):
+                raise IOError("Unable to load network %s" % path)
+        return cv2.dnn.readNetFromCaffe(self.config, self.weights)
+
+    def detect(self, net, img, scale=1.0):
+        """
+        A method to detect the biggest face of a frame.
+
+        Args:
+            net: instance returned by ``load``.
+            img: RGB or grayscale frame.
+            scale: ignored.
+        """
+        return self.detect_batch(net, [img])[0]
+
+    def detect_batch(self, net, images, scale=1.0):
+        """
+        A method to detect the biggest face of several frames with one
+        forward pass.
+
+        Args:
+            net: instance returned by ``load``.
+            images: RGB or grayscale frames.
+            scale: ignored.
+        """
+        frames = [cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2
+                  else cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                  for img in images]
+        net.setInput(cv2.dnn.blobFromImages(frames, 1.0, self.SIZE,
+                                            self.MEAN, False, False))
+        detections = net.forward().reshape(-1, 7)
+        results = []
+        for n, img in enumerate(images):
+            height, width = img.shape[:2]
+            rows = detections[(detections[:, 0] == n) &
+                              (detections[:, 2] >= self.confidence)]
+            boxes = np.rint(np.clip(rows[:, 3:7], 0, 1) *
+                            [width, height, width, height]).astype(np.int32)
+            boxes[:, 2:] -= boxes[:, :2]
+            boxes = boxes[(boxes[:, 2] > 0) & (boxes[:, 3] > 0)]
+            if len(boxes) == 0:
+                results.append([])
+                continue
+            biggest = (boxes[:, 2] * boxes[:, 3]).argmax()
+            results.append(boxes[biggest:biggest + 1])
+        return results
+
+
+class DetectorRegistry(object):
+    """
+    Registry of the face detector backends.
+
+    The models are loaded once per thread instead of once per frame,
+    ``CascadeClassifier.detectMultiScale`` and ``Net.forward`` are not safe
+    to call on the same instance from several threads so every worker
+    thread keeps its own copy. ``reload`` bumps a version number and each
+    thread reloads its copies on its next call. ``DETECTOR`` names the
+    backend used when none is given.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._backends = {}
+        self._version = 0
+        self.load_time = {}
+        self.latency = {}
+
+    def register(self, name, backend):
+        """
+        A method to register a detector backend under a name.
+
+        Args:
+            name: name used to look up the backend.
+            backend: CascadeDetector, DnnDetector or the path to a cascade
+                XML file.
+        """
+        if isinstance(backend, basestring):
+            backend = CascadeDetector(backend)
+        with self._lock:
+            self._backends[name] = backend
+            self.latency.setdefault(name, LatencyStats())
+            self._version += 1
+
+    def names(self):
+        """
+        A method to return the names of the registered backends.
+        """
+        return sorted(self._backends)
+
+    def load(self):
+        """
+        A method to load the configured backend in the calling thread, it
+        is called at startup so that a missing file fails early.
+        """
+        self.get(DETECTOR)
+
+    def reload(self):
+        """
+        A method to reload the models from disk on their next use.
+        """
+        with self._lock:
+            self._version += 1
+        self.load()
+
+    def get(self, name):
+        """
+        A method to return the calling thread's copy of a model.
+
+        Args:
+            name: name of the registered backend.
+        """
+        local = self._local
+        if getattr(local, 'version', None) != self._version:
+            local.version = self._version
+            local.models = {}
+        model = local.models.get(name)
+        if model is None:
+            model = self._load(name)
+            local.models[name] = model
+        return model
+
+    def _load(self, name):
+        backend = self._backends[name]
+        start = time.time()
+        model = backend.load()
+        self.load_time[name] = time.time() - start
+        logging.info("Loaded %s detector in %.1f ms" %
+                     (name, self.load_time[name] * 1000))
+        return model
+
+    def detect(self, img, name=None, scale=1.0):
+        """
+        A method to detect faces with a registered backend.
+
+        Args:
+            img: RGB image to search.
+            name: name of the registered backend, ``DETECTOR`` by default.
+            scale: factor the image is shrunk by for the search.
+        """
+        name = name or DETECTOR
+        model = self.get(name)
+        start = time.time()
+        faces = self._backends[name].detect(model, img, scale)
+        self.latency[name].add(time.time() - start)
+        return faces
+
+    def detect_batch(self, images, name=None, scale=1.0):
+        """
+        A method to detect the faces of several frames, in one pass with
+        the backends that support it.
+
+        Args:
+            images: RGB or grayscale frames.
+            name: name of the registered backend, ``DETECTOR`` by default.
+            scale: factor the images are shrunk by for the search.
+        """
+        name = name or DETECTOR
+        model = self.get(name)
+        start = time.time()
+        faces = self._backends[name].detect_batch(model, images, scale)
+        self.latency[name].add(time.time() - start)
+        return faces
+
+    def stats(self):
+        """
+        A method to return the load time and detect latency per backend.
+        """
+        return dict((name, {'load_ms': round(self.load_time.get(name, 0) *
+                                             1000, 3),
+                            'detect': self.latency[name].as_dict()})
+                    for name in self._backends)
+
+
+detectors = DetectorRegistry()
+detectors.register("haar", CASCADE_FILE)
+detectors.register("lbp", LBP_CASCADE_FILE)
+detectors.register("dnn", DnnDetector(DNN_CONFIG_FILE, DNN_WEIGHTS_FILE))
 
 
 class BaseModel(Model):
@@ -44,7 +382,7 @@ class Label(BaseModel):
     """
 
     IMAGE_DIR = "data/images"
-    name = CharField()
+    name = CharField(index=True)
 
     def persist(self):
         """
@@ -60,7 +398,8 @@ class Label(BaseModel):
             logging.info("Created directory: %s" % self.name)
             os.makedirs(path)
 
-        Label.get_or_create(name=self.name)
+        label, created = Label.get_or_create(name=self.name)
+        label_index.add(label.id, label.name)
 
 
 class Image(BaseModel):
@@ -72,33 +411,186 @@ class Image(BaseModel):
     path = CharField()
     label = ForeignKeyField(Label)
 
-    def persist(self, cv_image):
+
+class Training(BaseModel):
+    """
+    Database table to store the training runs of the model.
+    """
+
+    version = IntegerField()
+    recognizer = CharField()
+    mode = CharField()
+    last_image = IntegerField()
+    images = IntegerField()
+    duration = FloatField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+def create_indexes():
+    """
+    A function to add the indexes of the label lookups to a database that
+    was created without them.
+    """
+
+    db.execute_sql("CREATE INDEX IF NOT EXISTS label_name ON label (name)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS image_label_id ON image "
+                   "(label_id)")
+
+
+class LabelIndex(object):
+    """
+    In-memory copy of the ``label`` table for the lookups done on every
+    frame.
+
+    The labels are read on first use, the labels persisted by this process
+    are added as they are created and a label missing from the index, e.g.
+    created by another process of the server, is read from the database
+    once. ``invalidate`` drops the copy after the table was changed in bulk.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._ids = None
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        names, ids = self._names, self._ids
+        if names is None:
+            with self._lock:
+                if self._names is None:
+                    rows = list(Label.select(Label.id, Label.name)
+                                .order_by(Label.id.desc()).tuples())
+                    self._names = dict(rows)
+                    # the lowest id wins for duplicated names
+                    self._ids = dict((name, label_id) for label_id, name
+                                     in rows)
+                names, ids = self._names, self._ids
+        return names, ids
+
+    def name(self, label_id):
+        """
+        A method to return the name of a label.
+
+        Args:
+            label_id: id of the label.
+
+        Raises:
+            Label.DoesNotExist: no label has this id.
         """
-        A method to save the images.
+        names, ids = self._load()
+        name = names.get(label_id)
+        if name is None:
+            self.misses += 1
+            name = Label.get(Label.id == label_id).name
+            self.add(label_id, name)
+        else:
+            self.hits += 1
+        return name
+
+    def get(self, name):
         """
-        path = os.path.join(self.IMAGE_DIR, self.label.name)
-        nr_of_images = len(os.listdir(path))
-        if nr_of_images >= 10:
-            return 'Done'
-        faces = detect_faces(cv_image)
-        if len(faces) > 0 and nr_of_images < 10:
-            path += "/%s.jpg" % nr_of_images
-            path = os.path.abspath(path)
-            logging.info("Saving %s" % path)
-            cropped = to_grayscale(crop_faces(cv_image, faces))
-            cv2.imwrite(path, cropped)
-            self.path = path
-            self.save()
+        A method to return a Label with its id and name without a query.
 
-def detect(img, cascade):
+        Args:
+            name: name of the label.
+
+        Raises:
+            Label.DoesNotExist: no label has this name.
+        """
+        names, ids = self._load()
+        label_id = ids.get(name)
+        if label_id is None:
+            self.misses += 1
+            label = Label.get(Label.name == name)
+            self.add(label.id, label.name)
+            return label
+        self.hits += 1
+        return Label(id=label_id, name=name)
+
+    def add(self, label_id, name):
+        """
+        A method to add a label created by this process.
+        """
+        with self._lock:
+            if self._names is not None:
+                self._names[label_id] = name
+                self._ids.setdefault(name, label_id)
+
+    def invalidate(self):
+        """
+        A method to read the labels from the database again on next use.
+        """
+        with self._lock:
+            self._names = self._ids = None
+
+    def stats(self):
+        """
+        A method to return the number of labels and lookups.
+        """
+        names = self._names
+        return {'labels': len(names) if names is not None else None,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+label_index = LabelIndex()
+
+def decode_frame(message):
+    """
+    A function to decode a websocket frame into a grayscale image.
+
+    JPEG frames are decoded by OpenCV straight from the message bytes. Raw
+    frames start with ``GRAY`` followed by the width and height as
+    little endian 16 bit integers and the pixels, they are used without
+    copying.
+
+    Args:
+        message: bytes received from the websocket.
+    """
+
+    if message[:4] == RAW_FRAME_MAGIC:
+        magic, width, height = RAW_FRAME_HEADER.unpack_from(message)
+        gray = np.frombuffer(message, np.uint8, width * height,
+                             RAW_FRAME_HEADER.size).reshape(height, width)
+        return gray
+    gray = cv2.imdecode(np.frombuffer(message, np.uint8),
+                        cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Unable to decode frame")
+    return gray
+
+def detect(img, cascade, scale=1.0):
     """
     A function to detect presence of a face.
+
+    Args:
+        img: RGB or grayscale frame.
+        cascade: cascade classifier.
+        scale: the search runs on a copy of the frame shrunk by this factor,
+            the boxes are mapped back to the frame. Between 0 and 1.
     """
 
-    gray = to_grayscale(img)
+    if not 0 < scale <= 1:
+        raise ValueError("Detection scale %r is not in (0, 1]" % scale)
+    height, width = img.shape[:2]
+    gray = img
+    if img.ndim == 3:
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY,
+                            dst=buffers.get("frame", height, width))
+    if scale < 1.0:
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        gray = cv2.resize(gray, size, dst=buffers.get("small", size[1],
+                                                      size[0]),
+                          interpolation=cv2.INTER_AREA)
+    if gray is img:
+        gray = cv2.equalizeHist(img, dst=buffers.get("frame", height, width))
+    else:
+        gray = cv2.equalizeHist(gray, dst=gray)
     scale_factor = 1.2
     min_neighbors = 5
-    min_size = (30, 30)
+    min_size = (int(round(DETECT_MIN_SIZE[0] * scale)),
+                int(round(DETECT_MIN_SIZE[1] * scale)))
     biggest_only = True
     flags = cv2.CASCADE_FIND_BIGGEST_OBJECT | \
             cv2.CASCADE_DO_ROUGH_SEARCH if biggest_only else \
@@ -110,22 +602,112 @@ def detect(img, cascade):
     # If nothing has been detected as a face
     if len(rects) == 0:
         return []
+    if scale < 1.0:
+        x_scale = float(width) / gray.shape[1]
+        y_scale = float(height) / gray.shape[0]
+        rects = np.rint(rects * [x_scale, y_scale, x_scale, y_scale])
+        rects = rects.astype(np.int32)
     return rects
 
-def detect_faces(img):
+def detect_faces(img, scale=1.0):
     """
     A  function that uses haarcascade to detect faces.
+
+    Args:
+        img: RGB or grayscale frame.
+        scale: factor the frame is shrunk by for the search.
     """
 
-    cascade = cv2.CascadeClassifier("data/haarcascade_frontalface_alt.xml")
-    return detect(img, cascade)
+    return detectors.detect(img, scale=scale)
+
+class FaceTracker(object):
+    """
+    Follow the face of one video stream so that most frames are searched
+    only around the face found in the previous one.
+
+    The cascade searches a region ``padding`` times the size of the last box
+    larger on every side. The whole frame is searched every ``full_every``
+    frames and as soon as the face is lost. The box returned is an
+    exponential moving average of the detections, it is reset when the face
+    jumps further than its own width. The searches run at ``scale``. A
+    tracker is not thread safe, each websocket session owns one and
+    processes one frame at a time.
+    """
+
+    def __init__(self, full_every=None, padding=TRACK_PADDING,
+                 smoothing=TRACK_SMOOTHING, scale=1.0):
+        self.full_every = full_every or TRACK_FULL_EVERY
+        self.scale = scale
+        self.padding = padding
+        self.smoothing = smoothing
+        self.box = None
+        self.since_full = 0
+        self.full_searches = 0
+        self.roi_searches = 0
+        self.lost = 0
+
+    def detect(self, img):
+        """
+        A method to detect the face of the next frame of the stream.
+
+        Args:
+            img: RGB or grayscale frame.
+
+        Returns:
+            array with the smoothed (x, y, w, h) box, empty if no face.
+        """
+        faces = []
+        if self.box is not None and self.since_full < self.full_every - 1:
+            self.since_full += 1
+            self.roi_searches += 1
+            faces = self._search_roi(img)
+            if len(faces) == 0:
+                self.lost += 1
+        if len(faces) == 0:
+            self.since_full = 0
+            self.full_searches += 1
+            faces = detectors.detect(img, scale=self.scale)
+        if len(faces) == 0:
+            self.box = None
+            return []
+        box = np.asarray(faces[0], np.float32)
+        if self.box is None or \
+                np.abs(box[:2] - self.box[:2]).max() > self.box[2]:
+            self.box = box
+        else:
+            self.box += self.smoothing * (box - self.box)
+        return np.rint(self.box).astype(np.int32).reshape(1, 4)
+
+    def _search_roi(self, img):
+        x, y, w, h = self.box
+        height, width = img.shape[:2]
+        x0 = max(0, int(x - w * self.padding))
+        y0 = max(0, int(y - h * self.padding))
+        x1 = min(width, int(x + w * (1 + self.padding)))
+        y1 = min(height, int(y + h * (1 + self.padding)))
+        faces = detectors.detect(img[y0:y1, x0:x1], scale=self.scale)
+        if len(faces) == 0:
+            return []
+        faces = np.array(faces)
+        faces[:, 0] += x0
+        faces[:, 1] += y0
+        return faces
+
+    def stats(self):
+        """
+        A method to return the number of full-frame and region searches.
+        """
+        return {'full_searches': self.full_searches,
+                'roi_searches': self.roi_searches,
+                'lost': self.lost}
 
 def to_grayscale(img):
     """
-    A function to convert rbg image to gray scale.
+    A function to convert rbg image to gray scale, grayscale images are only
+    equalized.
     """
 
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
     gray = cv2.equalizeHist(gray)
     return gray
 
@@ -147,25 +729,129 @@ def save(path, img):
 
     cv2.imwrite(path, img)
 
+class FrameBuffers(threading.local):
+    """
+    Scratch images of the calling thread reused from one frame to the next.
+
+    A buffer only grows, a smaller image is a view of its top left corner so
+    the face crops, whose size changes a little on every frame, do not
+    allocate.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, height, width):
+        """
+        A method to return a uint8 scratch image of the calling thread.
+
+        Args:
+            name: name of the buffer, one per use in a pipeline.
+            height: number of rows.
+            width: number of columns.
+        """
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape[0] < height or buf.shape[1] < width:
+            shape = (height, width) if buf is None else \
+                    (max(height, buf.shape[0]), max(width, buf.shape[1]))
+            buf = np.empty(shape, np.uint8)
+            self.buffers[name] = buf
+        return buf[:height, :width]
+
+
+buffers = FrameBuffers()
+_masks = {}
+
+def ellipse_mask(img, face):
+    """
+    A function to return the read only mask of the ellipse drawn in a face
+    box, masks are cached by size and position relative to the frame edges.
+
+    The ellipse is drawn on the part of the frame around the box that it
+    can cover so that it is clipped by the same edges as when it is drawn
+    on the whole frame.
+
+    Args:
+        img: frame of the face.
+        face: (x, y, w, h) box of the face.
+    """
+
+    x, y, h, w = [int(value) for value in face]
+    rows, cols = img.shape[:2]
+    margin = max(h, w) / 2 + 2
+    left, top = min(x, margin), min(y, margin)
+    # the canvas ends where the frame or the margin ends
+    canvas_height = min(y + h + margin, rows) - y + top
+    canvas_width = min(x + w + margin, cols) - x + left
+    key = (h, w, left, top, canvas_height, canvas_width)
+    mask = _masks.get(key)
+    if mask is None:
+        if len(_masks) >= MASK_CACHE_SIZE:
+            _masks.clear()
+        canvas = np.zeros((canvas_height, canvas_width), np.uint8)
+        cv2.ellipse(canvas, center=(left + w / 2, top + h / 2),
+                    axes=(h / 2, w / 2), angle=0, startAngle=0,
+                    endAngle=360, color=255, thickness=-1)
+        mask = canvas[top:top + h, left:left + w]
+        mask.setflags(write=False)
+        _masks[key] = mask
+    return mask
+
+def _face_roi(img, face):
+    x, y, h, w = [int(value) for value in face]
+    return img[y:y+h, x:x+w], ellipse_mask(img, face)
+
 def crop_faces(img, faces):
     """
-    A function to crop the images.
+    A function to crop the images, only the region of the last face is
+    masked with an ellipse.
+    """
+
+    roi, mask = _face_roi(img, faces[-1])
+    return cv2.bitwise_and(roi, roi, mask=mask)
+
+def crop_face(img, face, out=None):
+    """
+    A function to crop a face out of a frame as a masked and equalized
+    grayscale image, the same as ``to_grayscale(crop_faces(img, [face]))``
+    but without converting or copying anything outside the face.
+
+    Args:
+        img: RGB or grayscale frame.
+        face: (x, y, w, h) box of the face.
+        out: image of the size of the box to write to, a new one is
+            allocated without it.
+    """
+
+    roi, mask = _face_roi(img, face)
+    height, width = mask.shape
+    if roi.ndim == 3:
+        roi = cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY,
+                           dst=buffers.get("crop", height, width))
+    if out is None:
+        out = np.empty((height, width), np.uint8)
+    out = cv2.bitwise_and(roi, mask, dst=out)
+    return cv2.equalizeHist(out, dst=out)
+
+def normalise_face(img, face, out=None):
     """
+    A function to return the 100x100 normalised face given to the
+    recognizer, the same as ``cv2.resize(to_grayscale(crop_faces(img,
+    [face])), (100, 100))``. The intermediate images are scratch buffers of
+    the calling thread.
 
-    for face in faces:
-        x, y, h, w = [result for result in face]
-        center = (x + w / 2, y + h / 2)
-        axis_major = h / 2
-        axis_minor = w / 2
-        mask = np.zeros_like(img)
-        # create a white filled ellipse
-        mask = cv2.ellipse(mask, center=center, axes=(axis_major, axis_minor),
-                           angle=0, startAngle=0, endAngle=360,
-                           color=(255, 255, 255), thickness=-1)
-        # Bitwise AND operation to black out regions outside the mask
-        images_ellipse = np.bitwise_and(img, mask)
+    Args:
+        img: RGB or grayscale frame.
+        face: (x, y, w, h) box of the face.
+        out: 100x100 image to write to, a new one is allocated without it.
+    """
 
-    return images_ellipse[y:y+h,x:x+w]
+    x, y, h, w = [int(value) for value in face]
+    height, width = img[y:y+h, x:x+w].shape[:2]
+    cropped = crop_face(img, face, buffers.get("face", height, width))
+    if out is None:
+        out = np.empty(FACE_SIZE[::-1], np.uint8)
+    return cv2.resize(cropped, FACE_SIZE, dst=out)
 
 
 def load_images(path):
@@ -199,80 +885,1148 @@ def load_images(path):
 
 def load_images_to_db(path):
     """
-    A function to load the images from the database.
+    A function to reconcile the images on disk with the database.
+
+    Labels and images that are missing from the database are inserted in
+    bulk and the rows of the images under ``path`` that no longer exist are
+    deleted, all in a single transaction.
 
     Args:
         path: image path.
+
+    Returns:
+        (added, removed): number of image rows inserted and deleted.
     """
 
+    on_disk = {}
     for dirname, dirnames, filenames in os.walk(path):
         for subdirname in dirnames:
             subject_path = os.path.join(dirname, subdirname)
-            label, created = Label.get_or_create(name=subdirname)
-            label.save()
             for filename in os.listdir(subject_path):
-                path = os.path.abspath(os.path.join(subject_path, filename))
-                logging.info('saving path %s' % path)
-                image, created = Image.get_or_create(path=path, label=label)
-                image.save()
+                image_path = os.path.abspath(os.path.join(subject_path,
+                                                          filename))
+                if os.path.isfile(image_path):
+                    on_disk[image_path] = subdirname
+
+    root = os.path.join(os.path.abspath(path), "")
+    with db.atomic():
+        labels = dict(Label.select(Label.name, Label.id).tuples())
+        new_labels = set(on_disk.values()) - set(labels)
+        for chunk in chunks([{'name': name} for name in new_labels], 100):
+            Label.insert_many(chunk).execute()
+        if new_labels:
+            labels = dict(Label.select(Label.name, Label.id).tuples())
+            label_index.invalidate()
+
+        in_db = set(image_path for (image_path,) in
+                    Image.select(Image.path).tuples())
+        added = [{'path': image_path, 'label': labels[name]}
+                 for image_path, name in on_disk.iteritems()
+                 if image_path not in in_db]
+        for chunk in chunks(added, 100):
+            Image.insert_many(chunk).execute()
+        removed = [image_path for image_path in in_db
+                   if image_path.startswith(root) and
+                   image_path not in on_disk]
+        for chunk in chunks(removed, 100):
+            Image.delete().where(Image.path << chunk).execute()
+
+    logging.info("Added %d and removed %d images" %
+                 (len(added), len(removed)))
+    return len(added), len(removed)
+
+def chunks(items, size):
+    """
+    A function to split a list in lists of at most ``size`` items, SQLite
+    limits the number of variables in a query.
+    """
+
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
 
-def load_images_from_db():
+def read_face(path):
+    """
+    A function to read an image as a normalised 100x100 grayscale face,
+    ``None`` if it can not be read.
+
+    Args:
+        path: image path.
+    """
+
+    cv_image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if cv_image is None:
+        return None
+    return cv2.resize(cv_image, FACE_SIZE)
+
+
+class FaceCache(object):
+    """
+    Normalised faces of the ``image`` table stored in one memory-mappable
+    file.
+
+    The file holds the stack of faces sorted by ``Image.id`` followed by the
+    id, mtime and SHA-1 of the path of every face, written by
+    ``save_arrays`` and renamed in one step so the two always match. A face
+    is decoded again only when its path or mtime changed, new and changed
+    images are decoded on a thread per core since ``cv2.imread`` and
+    ``cv2.resize`` release the GIL.
+    """
+
+    INDEX_DTYPE = np.dtype([('id', np.int64), ('mtime', np.float64),
+                            ('path', 'S40')])
+
+    def __init__(self, path=FACE_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _open(self):
+        try:
+            arrays = load_arrays(self.path)
+            if (len(arrays) == 2 and arrays[1].dtype == self.INDEX_DTYPE and
+                    len(arrays[0]) == len(arrays[1])):
+                return arrays
+            logging.warning("Face cache %s is inconsistent" % self.path)
+        except (IOError, OSError, ValueError):
+            pass
+        return (np.empty((0,) + FACE_SIZE, np.uint8),
+                np.empty(0, self.INDEX_DTYPE))
+
+    def load(self, rows, prune=False):
+        """
+        A method to return the faces of the given images.
+
+        Args:
+            rows: iterable of (id, path) tuples of the images, read once.
+            prune: drop the cached faces of the images that are not in
+                ``rows``.
+
+        Returns:
+            faces: array of shape (n, 100, 100) mapped from the cache file.
+            ids: ids of the faces, images that can not be read are skipped.
+        """
+        with self._lock:
+            return self._load(rows, prune)
+
+    def _load(self, rows, prune):
+        cached, index = self._open()
+        positions = dict(zip(index['id'].tolist(), range(len(index))))
+        entries = {}
+        for image_id, path in rows:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                logging.warning("Missing image %s" % path)
+                continue
+            if isinstance(path, unicode):
+                path = path.encode("utf-8")
+            digest = hashlib.sha1(path).hexdigest()
+            i = positions.get(image_id)
+            if i is not None and (index['mtime'][i] != mtime or
+                                  index['path'][i] != digest):
+                i = None
+            entries[image_id] = (path, digest, mtime, i)
+
+        stale = [image_id for image_id, entry in entries.iteritems()
+                 if entry[3] is None]
+        decoded = {}
+        if stale:
+            start = time.time()
+            workers = ThreadPoolExecutor(multiprocessing.cpu_count())
+            try:
+                paths = [entries[image_id][0] for image_id in stale]
+                decoded = dict(zip(stale, workers.map(read_face, paths)))
+            finally:
+                workers.shutdown()
+            for image_id, face in decoded.items():
+                if face is None:
+                    logging.warning("Unable to read %s" %
+                                    entries.pop(image_id)[0])
+                    del decoded[image_id]
+            logging.info("Decoded %d faces in %.1f s" %
+                         (len(stale), time.time() - start))
+
+        kept = [] if prune else [i for i, image_id in
+                                 enumerate(index['id'].tolist())
+                                 if image_id not in entries]
+        if decoded or len(kept) + len(entries) != len(index):
+            cached, index = self._write(cached, index, kept, entries,
+                                        decoded)
+            positions = dict(zip(index['id'].tolist(), range(len(index))))
+
+        ids = sorted(entries)
+        selected = [positions[image_id] for image_id in ids]
+        if not selected:
+            return cached[:0], ids
+        if selected[-1] - selected[0] + 1 == len(selected):
+            # a contiguous range is returned as a view of the mapped file
+            return cached[selected[0]:selected[-1] + 1], ids
+        return cached[selected], ids
+
+    def _write(self, cached, index, kept, entries, decoded):
+        merged = [(index['id'][i], index['path'][i], index['mtime'][i], i)
+                  for i in kept]
+        merged += [(image_id, digest, mtime, i) for image_id,
+                   (path, digest, mtime, i) in entries.iteritems()]
+        merged.sort()
+        new_index = np.empty(len(merged), self.INDEX_DTYPE)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            # the faces are streamed one by one, as save_arrays lays them out
+            np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                    'fortran_order': False,
+                    'shape': (len(merged),) + FACE_SIZE})
+            for n, (image_id, digest, mtime, i) in enumerate(merged):
+                face = decoded[image_id] if i is None else cached[i]
+                f.write(np.ascontiguousarray(face, np.uint8).tobytes())
+                new_index[n] = (image_id, mtime, digest)
+            np.lib.format.write_array(f, new_index)
+        os.rename(tmp, self.path)
+        return self._open()
+
+
+faces = FaceCache()
+
+def load_images_from_db(since=0, until=None):
     """
     A function to load the images from database.
+
+    The images and their labels are read with one joined query whose rows
+    are streamed into arrays sized with ``COUNT(*)``. The faces come from
+    the FaceCache, only the images that are new or changed since the last
+    load are decoded.
+
+    Args:
+        since: only load the images with a greater id.
+        until: only load the images up to this id.
+    """
+
+    query = (Image.select(Image.id, Image.path, Image.label)
+             .join(Label).where(Image.id > since))
+    if until is not None:
+        query = query.where(Image.id <= until)
+    count = query.count()
+    ids = np.empty(count, np.int64)
+    labels = np.empty(count, np.int32)
+    loaded = [0]
+
+    def rows():
+        cursor = query.order_by(Image.id).tuples().iterator()
+        # rows inserted after the count are left for the next training
+        for n, (image_id, path, label_id) in enumerate(
+                itertools.islice(cursor, count)):
+            ids[n] = image_id
+            labels[n] = label_id
+            loaded[0] = n + 1
+            yield image_id, path
+
+    images, image_ids = faces.load(rows(), prune=since == 0)
+    positions = np.searchsorted(ids[:loaded[0]], image_ids)
+    return images, labels[positions]
+
+def create_recognizer():
+    """
+    A function to create an empty face recognizer.
+    """
+
+    if RECOGNIZER == "lbph":
+        return cv2.face.createLBPHFaceRecognizer()
+    return cv2.face.createFisherFaceRecognizer()
+    #return cv2.createEigenFaceRecognizer()
+
+
+def save_arrays(path, arrays):
+    """
+    A function to atomically write arrays one after the other in the
+    ``.npy`` format to a single file.
+
+    Args:
+        path: destination file.
+        arrays: list of numpy arrays.
+    """
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        for array in arrays:
+            np.lib.format.write_array(f, np.ascontiguousarray(array))
+    os.rename(tmp, path)
+
+
+def load_arrays(path):
+    """
+    A function to map read only the arrays written by ``save_arrays``. The
+    pages are shared by every process that maps the file.
+
+    Args:
+        path: file written by ``save_arrays``.
+
+    Returns:
+        list of numpy memmaps.
+    """
+
+    arrays = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while f.tell() < size:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            offset = f.tell()
+            array = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                              shape=shape,
+                              order='F' if fortran_order else 'C')
+            arrays.append(array)
+            f.seek(offset + array.nbytes)
+    return arrays
+
+
+class SubspaceEngine(object):
+    """
+    NumPy nearest neighbour classifier over the subspace of a trained
+    Fisherfaces (or Eigenfaces) model.
+
+    The gallery is projected once when the engine is built, a batch of faces
+    is then classified with one projection and one distance matrix product,
+    giving the same labels and distances as ``model.predict``.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.mean = model.getMean().reshape(-1).astype(np.float32)
+        self.eigenvectors = model.getEigenVectors().astype(np.float32)
+        self.gallery = np.vstack(model.getProjections()).astype(np.float32)
+        self.labels = np.asarray(model.getLabels()).reshape(-1)
+        self.gallery_norms = (self.gallery ** 2).sum(axis=1)
+
+    @classmethod
+    def load(cls, path):
+        """
+        A method to map an engine written by ``save`` without the model.
+
+        Args:
+            path: file written by ``save``.
+        """
+        engine = cls.__new__(cls)
+        engine.model = None
+        (engine.mean, engine.eigenvectors, engine.gallery, engine.labels,
+         engine.gallery_norms) = load_arrays(path)
+        return engine
+
+    def save(self, path):
+        """
+        A method to write the arrays of the engine to a file.
+
+        Args:
+            path: destination file.
+        """
+        save_arrays(path, [self.mean, self.eigenvectors, self.gallery,
+                           self.labels, self.gallery_norms])
+
+    def predict_batch(self, faces):
+        """
+        A method to predict the labels of a batch of faces.
+
+        Args:
+            faces: list of 100x100 grayscale faces.
+
+        Returns:
+            list of (label, distance) tuples.
+        """
+        probes = np.empty((len(faces), self.mean.size), np.float32)
+        for i, face in enumerate(faces):
+            probes[i] = face.reshape(-1)
+        probes -= self.mean
+        projected = probes.dot(self.eigenvectors)
+        distances = projected.dot(self.gallery.T)
+        distances *= -2
+        distances += self.gallery_norms
+        distances += (projected ** 2).sum(axis=1)[:, np.newaxis]
+        nearest = distances.argmin(axis=1)
+        best = np.sqrt(np.maximum(distances[np.arange(len(faces)), nearest],
+                                  0))
+        return [(int(self.labels[i]), float(distance))
+                for i, distance in zip(nearest, best)]
+
+
+class IdentityIndex(object):
+    """
+    Nearest identities of a face without comparing it with every face of the
+    gallery of a Fisherfaces (or Eigenfaces) model.
+
+    The projected gallery is grouped by label and every label is summed up
+    by the centroid of its faces. The leading ``INDEX_DIMENSIONS``
+    components of the centroids, the most discriminant ones, are kept in a
+    KD-tree since the tree stops pruning in many more dimensions. A face is
+    compared in the whole subspace with the faces of the labels of its
+    ``candidates`` nearest centroids only, so the cost of a query grows with
+    the logarithm of the number of labels instead of the number of faces.
+    The label of the nearest face is the one ``model.predict`` gives as long
+    as it belongs to one of the candidates. Below ``INDEX_MIN_LABELS`` the
+    tree costs more than it saves and every face is compared.
+
+    The gallery is stored sorted by label with the centroids and the
+    pickled tree, so ``load`` maps the arrays shared by every process
+    without computing anything.
+    """
+
+    def __init__(self, mean, eigenvectors, gallery, labels, gallery_norms,
+                 ids, offsets, centroids, tree):
+        self.mean = mean
+        self.eigenvectors = eigenvectors
+        self.gallery = gallery
+        self.labels = labels
+        self.gallery_norms = gallery_norms
+        self.ids = ids
+        self.offsets = offsets
+        self.centroids = centroids
+        self.tree = tree
+
+    @classmethod
+    def build(cls, mean, eigenvectors, gallery, labels):
+        """
+        A method to build the index of a projected gallery.
+
+        Args:
+            mean: mean face of the model, flattened.
+            eigenvectors: projection of the model, one column per component.
+            gallery: projected faces, one row per face.
+            labels: label of every face.
+        """
+        if KDTree is None:
+            raise RuntimeError("The identity index needs scikit-learn")
+        order = np.argsort(labels, kind="mergesort")
+        gallery = np.ascontiguousarray(gallery[order])
+        labels = np.asarray(labels)[order]
+        ids, starts, counts = np.unique(labels, return_index=True,
+                                        return_counts=True)
+        centroids = (np.add.reduceat(gallery, starts) /
+                     counts[:, np.newaxis].astype(np.float32))
+        return cls(mean, eigenvectors, gallery, labels,
+                   (gallery ** 2).sum(axis=1), ids,
+                   np.append(starts, len(labels)), centroids,
+                   KDTree(centroids[:, :INDEX_DIMENSIONS]))
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        A method to build the index of a trained recognizer.
+
+        Args:
+            model: trained Fisherfaces or Eigenfaces recognizer.
+        """
+        return cls.build(model.getMean().reshape(-1).astype(np.float32),
+                         model.getEigenVectors().astype(np.float32),
+                         np.vstack(model.getProjections()).astype(np.float32),
+                         np.asarray(model.getLabels()).reshape(-1))
+
+    @classmethod
+    def load(cls, path):
+        """
+        A method to map an index written by ``save``.
+
+        Args:
+            path: file written by ``save``.
+        """
+        arrays = load_arrays(path)
+        tree = cPickle.loads(arrays[-1].tobytes())
+        return cls(*(arrays[:-1] + [tree]))
+
+    def save(self, path):
+        """
+        A method to write the arrays of the index to a file.
+
+        Args:
+            path: destination file.
+        """
+        tree = np.frombuffer(cPickle.dumps(self.tree, 2), np.uint8)
+        save_arrays(path, [self.mean, self.eigenvectors, self.gallery,
+                           self.labels, self.gallery_norms, self.ids,
+                           self.offsets, self.centroids, tree])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, faces, k=1, candidates=None):
+        """
+        A method to find the nearest identities of a batch of faces.
+
+        Args:
+            faces: list of 100x100 grayscale faces.
+            k: number of identities returned per face.
+            candidates: labels of the nearest centroids compared with each
+                face, ``INDEX_CANDIDATES`` by default and never less than k.
+
+        Returns:
+            list of lists of up to k (label, distance) tuples, the nearest
+            first. The distance is the one to the nearest face of the label.
+        """
+        probes = np.empty((len(faces), self.mean.size), np.float32)
+        for i, face in enumerate(faces):
+            probes[i] = face.reshape(-1)
+        probes -= self.mean
+        projected = probes.dot(self.eigenvectors)
+        if len(self.ids) < INDEX_MIN_LABELS:
+            return self._query_all(projected, k)
+        if candidates is None:
+            candidates = INDEX_CANDIDATES
+        candidates = min(max(candidates, k), len(self.ids))
+        nearest = self.tree.query(projected[:, :INDEX_DIMENSIONS],
+                                  k=candidates,
+                                  return_distance=False)
+        results = []
+        for probe, found in zip(projected, nearest):
+            starts = self.offsets[found]
+            ends = self.offsets[found + 1]
+            rows = np.concatenate([np.arange(start, end)
+                                   for start, end in zip(starts, ends)])
+            distances = self.gallery[rows].dot(probe)
+            distances *= -2
+            distances += self.gallery_norms[rows]
+            distances += probe.dot(probe)
+            bounds = np.append(0, np.cumsum(ends - starts)[:-1])
+            best = np.sqrt(np.maximum(np.minimum.reduceat(distances, bounds),
+                                      0))
+            ranked = best.argsort(kind="mergesort")[:k]
+            results.append([(int(self.ids[found[i]]), float(best[i]))
+                            for i in ranked])
+        return results
+
+    def _query_all(self, projected, k):
+        distances = projected.dot(self.gallery.T)
+        distances *= -2
+        distances += self.gallery_norms
+        distances += (projected ** 2).sum(axis=1)[:, np.newaxis]
+        best = np.sqrt(np.maximum(
+                np.minimum.reduceat(distances, self.offsets[:-1], axis=1), 0))
+        results = []
+        for row in best:
+            ranked = row.argsort(kind="mergesort")[:k]
+            results.append([(int(self.ids[i]), float(row[i]))
+                            for i in ranked])
+        return results
+
+    def predict_batch(self, faces):
+        """
+        A method to predict the labels of a batch of faces.
+
+        Args:
+            faces: list of 100x100 grayscale faces.
+
+        Returns:
+            list of (label, distance) tuples.
+        """
+        return [nearest[0] for nearest in self.query(faces)]
+
+    def predict(self, face):
+        """
+        A method to predict the label of a 100x100 grayscale face.
+
+        Args:
+            face: normalised face image.
+        """
+        return self.query([face])[0][0]
+
+
+class ModelManager(object):
+    """
+    Keep the trained recognizer in memory and serve every prediction from it.
+
+    A new model is written to a temporary file and renamed over ``path`` so
+    readers never see a half-written file, then the in-memory reference is
+    swapped. Predictions that already hold the old model finish with it.
+
+    The numpy engine is written next to the model and memory mapped, so the
+    processes of the server share one copy of it. A process notices that
+    another one saved a model with ``changed``. The identity index is kept
+    next to the model the same way.
     """
 
-    images, labels = [],[]
-    for label in Label.select():
-        for image in label.image_set:
+    def __init__(self, path=MODEL_FILE, engine_path=ENGINE_FILE,
+                 index_path=INDEX_FILE):
+        self.path = path
+        self.engine_path = engine_path
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._model = None
+        self._engine = None
+        self._index = None
+        self._loaded = None
+        self.version = 0
+
+    def get(self):
+        """
+        A method to return the current model, loading it on first use.
+        """
+        model = self._model
+        if model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+                    self.version += 1
+                model = self._model
+        return model
+
+    def _load(self):
+        start = time.time()
+        self._loaded = self._stamp()
+        model = create_recognizer()
+        model.load(self.path)
+        logging.info("Loaded model %s in %.1f ms" %
+                     (self.path, (time.time() - start) * 1000))
+        return model
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime
+
+    def changed(self):
+        """
+        A method to check whether ``path`` was replaced since the model was
+        loaded, e.g. by another process of the server.
+        """
+        stamp = self._stamp()
+        return stamp is not None and stamp != self._loaded
+
+    def reload(self):
+        """
+        A method to reload the model from disk, e.g. after another process
+        wrote a new ``model.mdl``. With the numpy engine only the engine
+        file is mapped and with the index engine only the index, the
+        recognizer is loaded again on demand.
+        """
+        if PREDICT_ENGINE == "numpy" and self._current(self.engine_path):
+            stamp = self._stamp()
+            engine = SubspaceEngine.load(self.engine_path)
+            with self._lock:
+                self._model = None
+                self._engine = engine
+                self._index = None
+                self._loaded = stamp
+                self.version += 1
+            return
+        if PREDICT_ENGINE == "index" and self._current(self.index_path):
+            stamp = self._stamp()
+            index = IdentityIndex.load(self.index_path)
+            with self._lock:
+                self._model = None
+                self._engine = None
+                self._index = index
+                self._loaded = stamp
+                self.version += 1
+            return
+        self.swap(self._load())
+
+    def swap(self, model):
+        """
+        A method to replace the in-memory model.
+
+        Args:
+            model: trained recognizer.
+        """
+        with self._lock:
+            self._model = model
+            self._engine = None
+            self._index = None
+            self.version += 1
+        if PREDICT_ENGINE == "numpy":
+            self.engine()
+        elif PREDICT_ENGINE == "index":
+            self.index()
+
+    def save(self, model):
+        """
+        A method to atomically write a trained model to disk and swap it in.
+
+        Args:
+            model: trained recognizer.
+        """
+        base, ext = os.path.splitext(self.path)
+        tmp = "%s.%d.tmp%s" % (base, os.getpid(), ext)
+        model.save(tmp)
+        os.rename(tmp, self.path)
+        self._loaded = self._stamp()
+        if PREDICT_ENGINE == "numpy":
+            SubspaceEngine(model).save(self.engine_path)
+        elif PREDICT_ENGINE == "index":
+            IdentityIndex.from_model(model).save(self.index_path)
+        self.swap(model)
+
+    def predict(self, face):
+        """
+        A method to predict the label of a 100x100 grayscale face.
+
+        Args:
+            face: normalised face image.
+        """
+        return self.get().predict(face)
+
+    def _current(self, path):
+        try:
+            return os.path.getmtime(path) >= os.path.getmtime(self.path)
+        except OSError:
+            return False
+
+    def engine(self):
+        """
+        A method to return the SubspaceEngine of the current model, mapped
+        from ``engine_path`` when the file is not older than the model and
+        otherwise built from the model and written there.
+        """
+        engine = self._engine
+        if engine is None:
+            start = time.time()
+            if self._current(self.engine_path):
+                engine = SubspaceEngine.load(self.engine_path)
+            else:
+                engine = SubspaceEngine(self.get())
+                engine.save(self.engine_path)
+            self._engine = engine
+            logging.info("Loaded subspace engine in %.1f ms" %
+                         ((time.time() - start) * 1000))
+        return engine
+
+    def index(self):
+        """
+        A method to return the IdentityIndex of the current model, loaded
+        from ``index_path`` when the file is not older than the model and
+        otherwise built from the model and written there.
+        """
+        index = self._index
+        if index is None:
+            start = time.time()
+            if self._current(self.index_path):
+                index = IdentityIndex.load(self.index_path)
+            else:
+                index = IdentityIndex.from_model(self.get())
+                index.save(self.index_path)
+            self._index = index
+            logging.info("Loaded identity index of %d labels in %.1f ms" %
+                         (len(index), (time.time() - start) * 1000))
+        return index
+
+
+class BatchPredictor(object):
+    """
+    Collect the faces predicted from many worker threads and classify them
+    together with the SubspaceEngine.
+
+    The first face of a batch waits at most ``max_delay`` seconds for more
+    faces, the calling threads block until their batch is classified.
+    """
+
+    def __init__(self, models, max_delay=0.005, max_size=64):
+        self.models = models
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = LatencyStats()
+        self.faces = 0
+
+    def predict(self, face):
+        """
+        A method to predict the label of a face as part of a batch.
+
+        Args:
+            face: 100x100 grayscale face.
+
+        Returns:
+            (label, distance) tuple.
+        """
+        self._start()
+        request = [face, threading.Event(), None]
+        self._queue.put(request)
+        request[1].wait()
+        if isinstance(request[2], Exception):
+            raise request[2]
+        return request[2]
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run,
+                                                    name="BatchPredictor")
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            start = time.time()
             try:
-                cv_image = cv2.imread(image.path, cv2.IMREAD_GRAYSCALE)
-                cv_image = cv2.resize(cv_image, (100,100))
-                images.append(np.asarray(cv_image, dtype=np.uint8))
-                labels.append(label.id)
-            except IOError, (errno, strerror):
-                print "IOError({0}): {1}".format(errno, strerror)
-    return images, np.asarray(labels)
+                results = self.models.engine().predict_batch(
+                        [request[0] for request in batch])
+            except Exception as e:
+                logging.exception("Batch prediction failed")
+                results = [e] * len(batch)
+            self.batches.add(time.time() - start)
+            self.faces += len(batch)
+            for request, result in zip(batch, results):
+                request[2] = result
+                request[1].set()
+
+    def stats(self):
+        """
+        A method to return the number of batches, faces and batch latency.
+        """
+        batches = self.batches.as_dict()
+        return {'batches': batches,
+                'faces': self.faces,
+                'mean_batch_size': round(float(self.faces) /
+                                         batches['count'], 2)
+                                   if batches['count'] else 0.0}
+
 
-def train():
+models = ModelManager()
+batcher = BatchPredictor(models)
+
+def train(full=False):
     """
     A function to train the images loaded from database.
+
+    The LBPH recognizer is updated with the images added since the last
+    training, Fisherfaces can not be updated and is always rebuilt. Every
+    run is recorded in the ``training`` table. A lock file next to the model
+    lets one process train at a time.
+
+    Args:
+        full: rebuild the model from every image.
     """
 
-    images, labels = load_images_from_db()
-    model = cv2.face.createFisherFaceRecognizer()
-    #model = cv2.createEigenFaceRecognizer()
-    #model = cv2.face.createLBPHFaceRecognizer()
-    model.train(images,labels)
-    model.save(MODEL_FILE)
+    with open(MODEL_FILE + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _train(full)
+
+def _train(full):
+    start = time.time()
+    Training.create_table(fail_silently=True)
+    previous = Training.select().order_by(Training.id.desc()).first()
+    last_image = latest_image()
+    incremental = (not full and RECOGNIZER == "lbph" and
+                   previous is not None and
+                   previous.recognizer == RECOGNIZER and
+                   previous.last_image <= last_image and
+                   os.path.exists(MODEL_FILE))
+    if incremental:
+        images, labels = load_images_from_db(previous.last_image, last_image)
+        if len(images) == 0:
+            logging.info("No new images since training %d" %
+                         previous.version)
+            return True
+        model = create_recognizer()
+        model.load(MODEL_FILE)
+        model.update(images, labels)
+    else:
+        images, labels = load_images_from_db(until=last_image)
+        model = create_recognizer()
+        model.train(images,labels)
+    models.save(model)
+
+    training = Training.create(
+            version=previous.version + 1 if previous else 1,
+            recognizer=RECOGNIZER,
+            mode="incremental" if incremental else "full",
+            last_image=last_image,
+            images=len(images),
+            duration=time.time() - start)
+    logging.info("Trained model version %d (%s, %d images) in %.1f s" %
+                 (training.version, training.mode, training.images,
+                  training.duration))
 
     return True
 
-def predict(cv_image):
+def latest_image():
+    """
+    A function to return the id of the newest image of the database, 0 if
+    there is none. The images trained on are the ones up to ``last_image``
+    of the last training.
+    """
+
+    return Image.select(fn.Max(Image.id)).scalar() or 0
+
+def last_training():
+    """
+    A function to return the latest training run, ``None`` if the model was
+    never trained.
+    """
+
+    Training.create_table(fail_silently=True)
+    training = Training.select().order_by(Training.id.desc()).first()
+    if training is None:
+        return None
+    return {'version': training.version,
+            'recognizer': training.recognizer,
+            'mode': training.mode,
+            'images': training.images,
+            'last_image': training.last_image,
+            'duration': round(training.duration, 3),
+            'created': training.created.isoformat()}
+
+def face_quality(face):
+    """
+    A function to score a normalised face for enrolment, sharp faces with
+    a strong variance of the Laplacian and frontal faces that look like
+    their mirror image score higher.
+
+    Args:
+        face: normalised 100x100 grayscale face.
+    """
+
+    sharpness = cv2.Laplacian(face, cv2.CV_64F).var()
+    asymmetry = cv2.absdiff(face, cv2.flip(face, 1)).mean()
+    return sharpness / (1.0 + asymmetry)
+
+
+class HarvestSession(object):
+    """
+    Collect the faces of one enrolment and keep the best of them.
+
+    The images already saved for the label are counted once when the
+    session starts. Every frame with a face fully inside it is scored with
+    ``face_quality`` and the best crops, cut from the frame at its full
+    resolution whatever the detection ``scale``, are kept in memory. They
+    are written together, with one transaction for their rows, after
+    ``candidates`` faces were scored or when ``finish`` is called. The
+    websocket session calls ``add`` from one worker thread at a time,
+    ``finish`` may be called from another one when the connection closes.
+    """
+
+    def __init__(self, label, keep=None, candidates=None, scale=1.0):
+        self.label = label
+        self.scale = scale
+        self.path = os.path.join(Image.IMAGE_DIR, label.name)
+        self.existing = len(os.listdir(self.path)) \
+            if os.path.isdir(self.path) else 0
+        self.keep = max(0, (keep or HARVEST_IMAGES) - self.existing)
+        self.candidates = candidates or HARVEST_CANDIDATES
+        self.scored = 0
+        self.saved = 0
+        self.best = []
+        self.done = self.keep == 0
+        self._lock = threading.Lock()
+
+    def add(self, cv_image):
+        """
+        A method to score the face of a frame.
+
+        Args:
+            cv_image: frame of the enrolment stream.
+
+        Returns:
+            True once the faces are saved.
+        """
+        faces = detect_faces(cv_image, self.scale)
+        if len(faces) == 0:
+            return self.done
+        x, y, w, h = faces[-1]
+        rows, cols = cv_image.shape[:2]
+        if x + w > cols or y + h > rows:
+            return self.done
+        score = face_quality(normalise_face(cv_image, faces[-1]))
+        crop = crop_face(cv_image, faces[-1])
+        with self._lock:
+            if self.done:
+                return True
+            self.scored += 1
+            entry = (score, self.scored, crop)
+            if len(self.best) < self.keep:
+                heapq.heappush(self.best, entry)
+            else:
+                heapq.heappushpop(self.best, entry)
+            if self.scored >= self.candidates:
+                self._save()
+            return self.done
+
+    def finish(self):
+        """
+        A method to save the best faces scored so far.
+        """
+        with self._lock:
+            if not self.done:
+                self._save()
+
+    def _save(self):
+        rows = []
+        number = self.existing
+        if self.best and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for score, n, crop in sorted(self.best, reverse=True):
+            while os.path.exists(os.path.join(self.path, "%d.jpg" % number)):
+                number += 1
+            path = os.path.abspath(os.path.join(self.path, "%d.jpg" % number))
+            cv2.imwrite(path, crop)
+            rows.append({'path': path, 'label': self.label.id})
+            number += 1
+        with db.atomic():
+            for chunk in chunks(rows, 100):
+                Image.insert_many(chunk).execute()
+        logging.info("Saved the best %d of %d faces of %s" %
+                     (len(rows), self.scored, self.label.name))
+        self.saved = len(rows)
+        self.best = []
+        self.done = True
+
+    def stats(self):
+        """
+        A method to return the number of scored and saved faces.
+        """
+        return {'scored': self.scored, 'kept': len(self.best),
+                'saved': self.saved, 'done': self.done}
+
+
+class IdentityCache(object):
+    """
+    Remember the identity predicted for the tracked face of one stream.
+
+    The identity is reused once the same label was predicted
+    ``IDENTITY_CONFIRMATIONS`` times in a row within
+    ``IDENTITY_MAX_DISTANCE``. It is predicted again after
+    ``IDENTITY_MAX_FRAMES`` frames, when the box moved or resized by more
+    than ``IDENTITY_MAX_SHIFT`` of its width, when a 16x16 thumbnail of the
+    face changed by more than ``IDENTITY_MAX_CHANGE`` gray levels on
+    average, or when a new model was loaded. Like FaceTracker it is owned by
+    one session.
+    """
+
+    THUMBNAIL_SIZE = (16, 16)
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        """
+        A method to forget the identity, e.g. when the face is lost.
+        """
+        self.name = None
+        self.distance = None
+        self.box = None
+        self.thumbnail = None
+        self.version = None
+        self.confirmations = 0
+        self.frames = 0
+
+    def _thumbnail(self, face):
+        return cv2.resize(face, self.THUMBNAIL_SIZE,
+                          interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def lookup(self, box, face):
+        """
+        A method to return the cached identity of a face if it can be
+        reused.
+
+        Args:
+            box: (x, y, w, h) of the face in the frame.
+            face: normalised 100x100 grayscale face.
+
+        Returns:
+            (name, distance) tuple, ``None`` if the face must be predicted.
+        """
+        if (self.name is None or self.frames >= IDENTITY_MAX_FRAMES or
+                self.confirmations < IDENTITY_CONFIRMATIONS or
+                self.version != models.version):
+            return None
+        shift = np.abs(np.asarray(box, np.float32) - self.box).max()
+        if shift > IDENTITY_MAX_SHIFT * self.box[2]:
+            return None
+        change = np.abs(self._thumbnail(face) - self.thumbnail).mean()
+        if change > IDENTITY_MAX_CHANGE:
+            return None
+        self.frames += 1
+        self.hits += 1
+        return self.name, self.distance
+
+    def store(self, box, face, name, distance):
+        """
+        A method to remember a freshly predicted identity.
+
+        Args:
+            box: (x, y, w, h) of the face in the frame.
+            face: normalised 100x100 grayscale face.
+            name: predicted label name.
+            distance: distance of the prediction.
+        """
+        if IDENTITY_MAX_DISTANCE and distance > IDENTITY_MAX_DISTANCE:
+            self.confirmations = 0
+        elif name == self.name:
+            self.confirmations += 1
+        else:
+            self.confirmations = 1
+        self.name = name
+        self.distance = distance
+        self.box = np.asarray(box, np.float32)
+        self.thumbnail = self._thumbnail(face)
+        self.version = models.version
+        self.frames = 0
+        self.misses += 1
+
+    def stats(self):
+        """
+        A method to return the number of cached and predicted identities.
+        """
+        return {'cached': self.hits, 'predicted': self.misses}
+
+def predict(cv_image, tracker=None, identity=None):
     """
     A function to predict the person infront of the camera.
 
     Args:
         cv_image: image captured from stream of video frames.
+        tracker: FaceTracker of the stream, the whole frame is searched
+            without it.
+        identity: IdentityCache of the stream, every face is predicted
+            without it.
 
     Returns:
-        result: Return results.
+        result: Return results, ``cached`` tells whether the identity was
+        reused from the IdentityCache.
     """
 
-    faces = detect_faces(cv_image)
+    if tracker is not None:
+        faces = tracker.detect(cv_image)
+    else:
+        faces = detect_faces(cv_image)
     result = None
     if len(faces) > 0:
-        cropped = to_grayscale(crop_faces(cv_image, faces))
-        resized = cv2.resize(cropped, (100,100))
+        resized = normalise_face(cv_image, faces[-1])
 
-        model = cv2.face.createFisherFaceRecognizer()
-        #model = cv2.createEigenFaceRecognizer()
-        #nmodel = cv2.face.createLBPHFaceRecognizer()
-        model.load(MODEL_FILE)
-        prediction = model.predict(resized)
+        prediction = None
+        if identity is not None:
+            prediction = identity.lookup(faces[0], resized)
+        cached = prediction is not None
+        if not cached:
+            if PREDICT_ENGINE == "numpy":
+                label, distance = batcher.predict(resized)
+            elif PREDICT_ENGINE == "index":
+                label, distance = models.index().predict(resized)
+            else:
+                label, distance = models.predict(resized)
+            prediction = (label_index.name(label), distance)
+            if identity is not None:
+                identity.store(faces[0], resized, *prediction)
         result = {
                   'face': {
-                          'name': Label.get(Label.id == prediction[0]).name,
+                          'name': prediction[0],
                           'distance': prediction[1],
+                          'cached': cached,
                           'coords': {
                                     'x': str(faces[0][0]),
                                     'y': str(faces[0][1]),
@@ -281,9 +2035,11 @@ def predict(cv_image):
                                     }
                           }
                  }
+    elif identity is not None:
+        identity.clear()
     return result
 
 if __name__ == "__main__":
     print "Beginning training"
-    train()
+    train(full=True)
     print "Done training"
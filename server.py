@@ -1,5 +1,7 @@
 #! /usr/bin/env python2.7
 # Import built in modules
+import datetime
+import errno
 import json
 import logging
 import mimetypes
@@ -7,23 +9,35 @@ import ntpath
 import os
 import os.path
 import ssl
-import StringIO
+import sys
+import threading
 import time
+import urllib
+
+from stat import S_ISDIR
 
 # Import third-part modules
-import numpy
+import tornado.concurrent
 import tornado.escape
+import tornado.gen
+import tornado.http1connection
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.netutil
 import tornado.options
+import tornado.process
+import tornado.template
 import tornado.web
 import tornado.websocket
 
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from tornado.options import define, options
 
 # Import custom modules
 from admin import admin
+from files import files
 from opencv import opencv
 #from syslog.syslog import ServerLog as sl
 
@@ -51,6 +65,122 @@ OPTIONS
 ``--listen-address`` specify the listen address for the server default is
     127.0.0.1.
 
+``--processes`` number of server processes forked after the images are
+    loaded, 0 starts one per CPU, default is 1. A training runs in the
+    process that received the request, the other processes load the new
+    model when they see ``model.mdl`` replaced.
+
+``--reuse-port`` bind a socket in every process with ``SO_REUSEPORT`` so
+    the kernel spreads the connections between them, by default the
+    processes share the socket bound before forking.
+
+``--read-buffer`` number of bytes read at a time from the served files,
+    default is 65536.
+
+``--sendfile-min-size`` files from this many kilobytes are copied to the
+    socket by the kernel with ``sendfile`` instead of being read into
+    python, except over TLS, default is 1024. 0 disables it. Python 2.7
+    needs the ``pysendfile`` module.
+
+``--file-cache-size`` megabytes of small files kept in memory with their
+    content type and etag, default is 0 which disables the cache.
+
+``--file-cache-max-file`` largest file in kilobytes kept in the file cache,
+    default is 256.
+
+``--gzip-cache-size`` megabytes of files compressed on the fly kept in
+    memory, default is 16. 0 disables compressing files on the fly.
+
+``--gzip-max-file`` largest file in kilobytes compressed on the fly, default
+    is 1024.
+
+``--precompress`` write the ``.gz`` and ``.br`` siblings of the text files
+    in a directory tree and exit, the file handler sends them as they are to
+    the clients that accept the encoding. ``/static`` does not use them, its
+    files are compressed on the fly.
+
+``--files-root`` directory served by the catch-all file handler, the url
+    paths are relative to it. Hidden files and paths leading out of it,
+    also through symbolic links, are answered with 404. Default is
+    ``uploads``.
+
+``--upload-root`` directory of the served tree the files uploaded to
+    ``/upload/<path>`` are written to, default is ``uploads``. The uploads
+    need the admin login.
+
+``--upload-max-size`` largest uploaded file in megabytes, default is 16384.
+
+``--listing-page-size`` number of entries per page of a directory listing,
+    default is 1000.
+
+``--workers`` number of threads running the opencv work, default is 4.
+
+``--worker-queue`` number of jobs allowed to wait for a free worker before
+    new frames are dropped and train requests are answered with 503, default
+    is 8.
+
+``--predict-engine`` ``opencv`` predict each face with the recognizer,
+    ``numpy`` classify the faces of all the connections in batches,
+    ``index`` compare each face only with the faces of the labels whose
+    centroid is nearest, for galleries of thousands of people. The index is
+    written to ``model.index`` at training, it needs scikit-learn.
+
+``--index-candidates`` labels of the nearest centroids compared with a face
+    by the index engine, default is 8. More candidates give the label of the
+    opencv engine more often and are slower.
+
+``--batch-delay`` maximum milliseconds a face waits for other faces to
+    form a batch with the numpy engine, default is 5.
+
+``--detector`` face detector backend, ``haar`` the Haar cascade
+    ``data/haarcascade_frontalface_alt.xml``, ``lbp`` the faster LBP
+    cascade ``data/lbpcascade_frontalface.xml`` or ``dnn`` the SSD network
+    of OpenCV ``data/deploy.prototxt`` and
+    ``data/res10_300x300_ssd_iter_140000.caffemodel`` run on the CPU. The
+    LBP cascade and the network are not shipped, they come with the OpenCV
+    sources and samples. ``dnn`` needs OpenCV 3.3 or newer, which no longer
+    has the ``cv2.face.create*`` recognizers of 3.2, the server refuses to
+    start without it. Default is ``haar``.
+
+``--facedetector-scale`` the faces of the ``/facedetector`` frames are
+    searched on a copy shrunk by this factor and their boxes mapped back to
+    the frame, between 0 and 1, default is 1. ``0.5`` searches a quarter
+    of the pixels.
+
+``--predict-scale`` the same for the ``/predict`` and ``/harvesting``
+    frames, the faces are always cropped from the full frame, default is 1.
+
+``--track-full-every`` the face detection and prediction streams search
+    only around the face of the previous frame, the whole frame is searched
+    every this many frames and when the face is lost, default is 10. 1
+    searches every frame.
+
+``--identity-max-frames`` once the same person was predicted twice in a
+    row the predict stream reuses the identity while the face stays still,
+    for at most this many frames, default is 15. 0 predicts every frame.
+    The replies tell with ``cached`` whether the identity was reused.
+
+``--identity-max-distance`` largest prediction distance of an identity
+    that is reused, default is 0 for any distance.
+
+``--harvest-candidates`` frames with a face scored for sharpness and pose
+    at enrolment before the best 10 are saved, default is 30.
+
+``--model-poll`` seconds between the checks for a model trained by another
+    process, default is 1.
+
+``--rebuild`` delete the labels and images from the database, load them
+    again from ``data/images`` and train the model before listening. By
+    default the database and ``model.mdl`` are reused, the database is
+    reconciled with ``data/images`` and the model is retrained in the
+    background only when something changed or images were harvested since
+    the last training.
+
+``--recognizer`` ``fisher`` rebuild the Fisherfaces model on every training,
+    ``lbph`` only add the faces harvested since the last training, a full
+    rebuild is done with ``/admin-panel/train?full=1``. The numpy and index
+    engines need ``fisher``, the server refuses to start otherwise.
+
 ENVIRONMENT
 ===========
 
@@ -63,6 +193,8 @@ EXAMPLES
 ::
     1. python2.7 server.py
     2. python2.7 server.py --port 8080 --listen-address 192.168.56.25
+    3. python2.7 server.py --processes 0 --predict-engine numpy
+    4. python2.7 server.py --precompress uploads
 
 
 
@@ -71,12 +203,168 @@ EXAMPLES
 define("port", default=8888, help="run on the given poort", type=int)
 define("listen_address", group="webserver", default="127.0.0.1", help="Listen\
         address")
+define("processes", group="webserver", default=1, help="number of server\
+        processes, 0 starts one per CPU", type=int)
+define("reuse_port", group="webserver", default=False, help="let every\
+        process bind its own socket with SO_REUSEPORT", type=bool)
+define("read_buffer", group="webserver", default=64 * 1024, help="bytes read\
+        at a time from the served files", type=int)
+define("sendfile_min_size", group="webserver", default=1024, help="files\
+        from this many kilobytes are sent with sendfile, over TLS they are\
+        read in chunks, 0 disables it", type=int)
+define("file_cache_size", group="webserver", default=0, help="megabytes of\
+        small files kept in memory, 0 disables the cache", type=int)
+define("file_cache_max_file", group="webserver", default=256, help="largest\
+        file in kilobytes kept in the file cache", type=int)
+define("gzip_cache_size", group="webserver", default=16, help="megabytes of\
+        gzip compressed files kept in memory, 0 disables compressing files\
+        on the fly", type=int)
+define("gzip_max_file", group="webserver", default=1024, help="largest file\
+        in kilobytes compressed on the fly", type=int)
+define("precompress", default=None, help="write the .gz and .br siblings of\
+        the text files under this directory and exit")
+define("files_root", group="webserver", default="uploads", help="directory\
+        served by the file handler")
+define("upload_root", group="webserver", default="uploads", help="directory\
+        the uploaded files are written to")
+define("upload_max_size", group="webserver", default=16384, help="largest\
+        uploaded file in megabytes", type=int)
+define("listing_page_size", group="webserver", default=1000, help="entries\
+        per page of a directory listing", type=int)
+define("workers", group="opencv", default=4, help="number of opencv worker\
+        threads", type=int)
+define("worker_queue", group="opencv", default=8, help="maximum number of\
+        jobs waiting for a worker", type=int)
+define("predict_engine", group="opencv", default="opencv", help="opencv,\
+        numpy for batched predictions or index for large galleries")
+define("index_candidates", group="opencv", default=8, help="labels of the\
+        nearest centroids compared with a face by the index engine",
+        type=int)
+define("batch_delay", group="opencv", default=5.0, help="maximum\
+        milliseconds a face waits for a batch with the numpy engine",
+        type=float)
+define("detector", group="opencv", default="haar", help="face detector\
+        backend: haar, lbp or dnn")
+define("facedetector_scale", group="opencv", default=1.0, help="factor\
+        the frames of /facedetector are shrunk by to detect faces",
+        type=float)
+define("predict_scale", group="opencv", default=1.0, help="factor the\
+        frames of /predict and /harvesting are shrunk by to detect faces",
+        type=float)
+define("track_full_every", group="opencv", default=10, help="frames of a\
+        stream between two searches of the whole frame", type=int)
+define("identity_max_frames", group="opencv", default=15, help="frames\
+        a recognized face is not predicted again, 0 predicts every frame",
+        type=int)
+define("identity_max_distance", group="opencv", default=0.0, help="largest\
+        distance of an identity that is reused, 0 for any", type=float)
+define("harvest_candidates", group="opencv", default=30, help="frames\
+        with a face scored at enrolment before the best are saved",
+        type=int)
+define("model_poll", group="opencv", default=1.0, help="seconds between\
+        the checks for a model trained by another process", type=float)
+define("rebuild", default=False, help="delete the image database and\
+        train before listening", type=bool)
+define("recognizer", group="opencv", default="fisher", help="fisher or lbph\
+        to add new faces to the model without retraining")
 # # enable ssl connection to secure the user bio data
 # ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
 # ssl_ctx.load_cert_chain(os.path.join('/home/hemedy99/Code/Python2.7',
 #     "mycert.pem"))
 
 
+class WorkerPoolSaturated(Exception):
+    """
+    Raised when a job is submitted to a worker pool that is already full.
+    """
+
+
+class WorkerPool(object):
+    """
+    Bounded thread pool that runs the opencv work off the IOLoop.
+
+    OpenCV releases the GIL while it decodes, detects and predicts so the
+    threads run in parallel. At most ``workers + max_queue`` jobs are
+    accepted at once, further jobs are rejected with ``WorkerPoolSaturated``
+    so that latency does not pile up behind a long queue.
+    """
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.wait = opencv.LatencyStats()
+        self.run = opencv.LatencyStats()
+
+    def saturated(self):
+        """
+        A method to check whether new jobs would be rejected.
+        """
+        return self.pending >= self.workers + self.max_queue
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        A method to run a function on a worker thread.
+
+        Args:
+            fn: function to call with ``args`` and ``kwargs``.
+
+        Returns:
+            future: resolved with the result of ``fn``.
+        """
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise WorkerPoolSaturated()
+            self.pending += 1
+        queued = time.time()
+
+        def run():
+            started = time.time()
+            self.wait.add(started - queued)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.run.add(time.time() - started)
+                with self._lock:
+                    self.pending -= 1
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        """
+        A method to return the queue depth, rejections and timings.
+        """
+        return {'workers': self.workers,
+                'pending': self.pending,
+                'queue_depth': max(0, self.pending - self.workers),
+                'rejected': self.rejected,
+                'wait': self.wait.as_dict(),
+                'run': self.run.as_dict()}
+
+
+class GZipTransform(tornado.web.GZipContentEncoding):
+    """
+    Compress the rendered pages, the static files and the directory
+    listings. The files sent by ServerFilesHandler, which negotiates their
+    encoding itself, are marked with ``encoding_negotiated`` on the request
+    and left alone.
+    """
+
+    def __init__(self, request):
+        super(GZipTransform, self).__init__(request)
+        self.request = request
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if getattr(self.request, "encoding_negotiated", False):
+            self._gzipping = False
+        return super(GZipTransform, self).transform_first_chunk(
+                status_code, headers, chunk, finishing)
+
+
 class Application(tornado.web.Application):
 
     def __init__(self):
@@ -92,6 +380,9 @@ class Application(tornado.web.Application):
             (r"/admin-panel", AdminPanelHandler),
             (r"/admin-panel/train", AdminTrainHandler),
             (r"/admin-panel/enrol", AdminEnrolHandler),
+            (r"/admin-panel/stats", AdminStatsHandler),
+            (r"/admin-panel/reload", AdminReloadHandler),
+            (r"/upload/(.*)", UploadHandler),
             (r"/(.*)", ServerFilesHandler)
             ]
 
@@ -102,9 +393,56 @@ class Application(tornado.web.Application):
             login_url="/admin/login/",
             xsrf_cookies=False,
             autoescape=None,
-            debug=True
+            debug=True,
+            autoreload=options.processes == 1
             )
-        tornado.web.Application.__init__(self, handlers, **settings)
+        tornado.web.Application.__init__(self, handlers,
+                                         transforms=[GZipTransform],
+                                         **settings)
+        self.workers = WorkerPool(options.workers, options.worker_queue)
+        self.train_lock = tornado.locks.Lock()
+        self.reloading = False
+        self.listings = files.DirectoryCache()
+        self.file_cache = None
+        if options.file_cache_size > 0:
+            self.file_cache = files.ContentCache(
+                    options.file_cache_size << 20,
+                    options.file_cache_max_file << 10)
+        self.gzip_cache = None
+        if options.gzip_cache_size > 0:
+            self.gzip_cache = files.ContentCache(options.gzip_cache_size << 20,
+                                                 options.gzip_max_file << 10,
+                                                 encoding="gzip")
+
+    @tornado.gen.coroutine
+    def train(self, full=False):
+        """
+        Train the model on the worker pool, one training at a time.
+
+        Args:
+            full: rebuild the model instead of adding the new faces.
+        """
+        if self.workers.saturated():
+            raise WorkerPoolSaturated()
+        with (yield self.train_lock.acquire()):
+            result = yield self.workers.submit(opencv.train, full)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def reload_model(self):
+        """
+        Load the model on the worker pool when another process of the server
+        trained a new one.
+        """
+        if (self.reloading or not opencv.models.changed() or
+                self.workers.saturated()):
+            return
+        self.reloading = True
+        try:
+            yield self.workers.submit(opencv.models.reload)
+            logging.info("Loaded the model trained by another process")
+        finally:
+            self.reloading = False
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -124,48 +462,166 @@ class SocketHandler(tornado.websocket.WebSocketHandler):
     """
     This class define several methods for open,status,close and reply to the
     users requests.
+
+    Every connection has a mailbox that holds only the newest frame that
+    has not been processed yet, one frame is processed at a time and frames
+    that are replaced before they are processed are dropped. The minimum
+    interval between two frames grows while the worker pool has a queue and
+    shrinks again when it has spare capacity.
     """
 
+    MIN_BACKOFF = 0.05 # seconds added when the server falls behind
+    MAX_INTERVAL = 2.0
+    RECOVERY = 0.01 # seconds removed when the server keeps up
+
+    sessions = set()
+    totals = {'received': 0, 'processed': 0, 'dropped': 0}
+
     def open(self):
 
         logging.info('new connection') # Display logging info in the terminal
+        self.latest = None
+        self.busy = False
+        self.interval = 0.0
+        self.last_start = 0.0
+        self.received = self.processed = self.dropped = 0
+        self.tracker = opencv.FaceTracker(scale=self.detect_scale())
+        SocketHandler.sessions.add(self)
 
     def on_message(self, message):
         """
-        This module process the user's request.
+        This module put the frame in the mailbox and start processing it
+        unless a frame is already being processed.
 
         Args:
             message: process the image received.
         """
-        image = Image.open(StringIO.StringIO(message))
-        cv_image = numpy.array(image)
-        self.process(cv_image)
+        self.received += 1
+        SocketHandler.totals['received'] += 1
+        if self.latest is not None:
+            self.count_drop()
+        self.latest = message
+        if not self.busy:
+            self.busy = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.drain)
+
+    @tornado.gen.coroutine
+    def drain(self):
+        """
+        Process the newest frame on the worker pool and reply with the
+        result until the mailbox is empty.
+        """
+        workers = self.application.workers
+        try:
+            while self.latest is not None and self.ws_connection is not None:
+                delay = self.last_start + self.interval - time.time()
+                if delay > 0:
+                    yield tornado.gen.sleep(delay)
+                message, self.latest = self.latest, None
+                self.last_start = time.time()
+                try:
+                    result = yield workers.submit(self.handle, message)
+                except WorkerPoolSaturated:
+                    self.count_drop()
+                    self.backoff()
+                    continue
+                self.processed += 1
+                SocketHandler.totals['processed'] += 1
+                if workers.pending > workers.workers:
+                    self.backoff()
+                else:
+                    self.interval = max(0.0, self.interval - self.RECOVERY)
+                if result is not None and self.ws_connection is not None:
+                    self.write_message(json.dumps(result))
+        except Exception:
+            logging.exception("Error processing frame")
+            self.close()
+        finally:
+            self.busy = False
+
+    def count_drop(self):
+        """
+        Count a frame that was dropped without being processed.
+        """
+        self.dropped += 1
+        SocketHandler.totals['dropped'] += 1
+
+    def backoff(self):
+        """
+        Increase the interval between frames while the server falls behind.
+        """
+        self.interval = min(self.MAX_INTERVAL,
+                            max(self.MIN_BACKOFF, self.interval * 2))
 
     def on_close(self):
 
         logging.info('connection closed')
+        self.latest = None
+        SocketHandler.sessions.discard(self)
+
+    @classmethod
+    def stats(cls):
+        """
+        Return the frame counters of every connection and their totals.
+        """
+        sessions = [{'path': session.request.path,
+                     'received': session.received,
+                     'processed': session.processed,
+                     'dropped': session.dropped,
+                     'interval_ms': round(session.interval * 1000, 1),
+                     'tracker': session.tracker.stats(),
+                     'identity': session.identity.stats()
+                                 if hasattr(session, 'identity') else None,
+                     'harvest': session.session.stats()
+                                if getattr(session, 'session', None)
+                                else None}
+                    for session in cls.sessions]
+        return {'totals': dict(cls.totals), 'sessions': sessions}
+
+    def detect_scale(self):
+        """
+        Return the factor the frames of this endpoint are shrunk by to
+        detect the faces.
+        """
+        return options.predict_scale
+
+    def handle(self, message):
+        """
+        This method decode the image and process it, it runs on a worker
+        thread.
+
+        Args:
+            message: jpeg or raw grayscale image received.
+        """
+        cv_image = opencv.decode_frame(message)
+        return self.process(cv_image)
 
     def process(self, cv_image):
-        pass
+        """
+        Process a decoded frame and return the reply, ``None`` for no reply.
+        """
+        return None
 
 
 class FaceDetectHandler(SocketHandler):
     """
     A class that contains  methods that process the  detection of the face when client connect tho the server.
     """
+    def detect_scale(self):
+        return options.facedetector_scale
+
     def process(self, cv_image):
         """
-        This method calls detect_faces from opencv module.
+        This method detect the face with the tracker of the connection.
 
         Args:
-            cv_image: detect_faces function use this image to detect presence of a face.
+            cv_image: the tracker use this image to detect presence of a face.
         """
-        faces = opencv.detect_faces(cv_image)
+        faces = self.tracker.detect(cv_image)
         if len(faces) > 0:
             # If a face has been detected display the results
             # in json format
-            result = json.dumps(faces.tolist())
-            self.write_message(result)
+            return faces.tolist()
 
 
 class SetupHarvestHandler(tornado.web.RequestHandler):
@@ -194,25 +650,39 @@ class SetupHarvestHandler(tornado.web.RequestHandler):
 class HarvestHandler(SocketHandler):
     """
     This class define a method that is used to process new user data based on the image and label.
+
+    The faces are scored by a ``opencv.HarvestSession`` and the best ones
+    are saved once enough frames were seen or when the connection closes.
     """
 
+    def open(self):
+        super(HarvestHandler, self).open()
+        self.session = None
+
     def process(self, cv_image):
         """
-        A function to get the user lable, cookie and prepaire a json  string.
+        A function to get the user lable from the cookie and give the frame
+        to the harvest session, ``Done`` is sent once the faces are saved.
 
         Args:
             cv_image: face image captured from video frames captured.
         """
-        label = opencv.Label.get(opencv.Label.name ==
-                                self.get_secure_cookie('label'))
-        logging.info("Got label: %s" % label.name)
-        if not label:
-            logging.info("No cookie, bailing out")
-            return
-        logging.info("About to save image")
-        result = opencv.Image(label=label).persist(cv_image)
-        if result == 'Done':
-            self.write_message(json.dumps(result))
+        if self.session is None:
+            label = opencv.label_index.get(self.get_secure_cookie('label'))
+            logging.info("Harvesting faces of %s" % label.name)
+            self.session = opencv.HarvestSession(label,
+                                                 scale=self.detect_scale())
+        if self.session.add(cv_image):
+            return 'Done'
+
+    def on_close(self):
+        super(HarvestHandler, self).on_close()
+        if self.session is not None and not self.session.done:
+            try:
+                self.application.workers.submit(self.session.finish)
+            except WorkerPoolSaturated:
+                logging.warning("Faces of %s not saved, workers saturated" %
+                                self.session.label.name)
 
 
 class TrainHandler(tornado.web.RequestHandler):
@@ -220,11 +690,16 @@ class TrainHandler(tornado.web.RequestHandler):
     This class contain a method that process the user's request by calling function ``train`` from opencv module.
     """
 
+    @tornado.gen.coroutine
     def post(self):
         """
         This method send request to the server for opencv to start trainning the  images.
         """
-        opencv.train()
+        try:
+            yield self.application.train()
+        except WorkerPoolSaturated:
+            self.set_header("Retry-After", "5")
+            raise tornado.web.HTTPError(503)
         # # Log the message
         # message = "Model Successfully Trained."
         # sl().model_train_stat(message)
@@ -236,6 +711,10 @@ class PredictHandler(SocketHandler):
     client connected to the server
     """
 
+    def open(self):
+        super(PredictHandler, self).open()
+        self.identity = opencv.IdentityCache()
+
     def process(self, cv_image):
         """
         This method start the prediction of the client connected to the
@@ -244,9 +723,9 @@ class PredictHandler(SocketHandler):
         Args:
             cv_image: face image from video frames captured.
         """
-        result = opencv.predict(cv_image)
+        result = opencv.predict(cv_image, self.tracker, self.identity)
         if result:
-            self.write_message(json.dumps(result))
+            return result
             # # Log the message
             # message = "Connected -: "
             # remote_ip = self.request.headers.get("Host")
@@ -320,9 +799,16 @@ class AdminTrainHandler(tornado.web.RequestHandler):
     Admin train handler for training the images.
     """
 
+    @tornado.gen.coroutine
     def get(self):
         logging.info("Training the model.")
-        if opencv.train() == True:
+        full = self.get_argument("full", None) is not None
+        try:
+            trained = yield self.application.train(full)
+        except WorkerPoolSaturated:
+            self.set_header("Retry-After", "5")
+            raise tornado.web.HTTPError(503)
+        if trained == True:
             message = "Model Successfully Trained"
             self.write(message)
             # Log the message
@@ -342,70 +828,527 @@ class AdminEnrolHandler(tornado.web.RequestHandler):
     def get(self):
         self.redirect("/enrol")
 
+
+class AdminStatsHandler(AdminPanelHandler):
+    """
+    Admin handler that report the server statistics in json format, with
+    several processes they are the ones of the process that answered.
+    """
+
+    @tornado.web.authenticated
+    def get(self):
+        self.write({'pid': os.getpid(),
+                    'detectors': opencv.detectors.stats(),
+                    'model_version': opencv.models.version,
+                    'training': opencv.last_training(),
+                    'labels': opencv.label_index.stats(),
+                    'workers': self.application.workers.stats(),
+                    'batches': opencv.batcher.stats(),
+                    'websockets': SocketHandler.stats(),
+                    'listings': self.application.listings.stats(),
+                    'file_cache': self.application.file_cache.stats()
+                                  if self.application.file_cache else None,
+                    'gzip_cache': self.application.gzip_cache.stats()
+                                  if self.application.gzip_cache else None})
+
+
+class AdminReloadHandler(AdminPanelHandler):
+    """
+    Admin handler that reload the face detector cascades and the trained
+    model from disk on the worker pool.
+    """
+
+    @tornado.web.authenticated
+    @tornado.gen.coroutine
+    def get(self):
+        workers = self.application.workers
+        try:
+            yield workers.submit(opencv.detectors.reload)
+            if not os.path.exists(opencv.MODEL_FILE):
+                self.set_status(404)
+                self.write("Detectors Reloaded, No Trained Model to Reload")
+                return
+            yield workers.submit(opencv.models.reload)
+        except WorkerPoolSaturated:
+            self.set_header("Retry-After", "5")
+            raise tornado.web.HTTPError(503)
+        self.write("Detectors and Model Successfully Reloaded")
+
+
+@tornado.web.stream_request_body
+class UploadHandler(AdminPanelHandler):
+    """
+    Admin handler that write a file of ``upload_root`` from the body of PUT
+    requests as it arrives, so the memory used does not depend on the size
+    of the file.
+
+    A file is sent whole or in pieces with a ``Content-Range`` header such
+    as ``bytes 0-1048575/4194304``. A piece starts at most at the number of
+    bytes already received, which GET returns, so an upload cut by a broken
+    connection goes on from there. A piece that ends the file replaces it
+    atomically and is answered with 201, the others with 202. Both replies
+    and a 409 for a piece that does not follow the bytes received, or
+    announces another total than the first piece, carry the
+    ``Upload-Offset`` header.
+    """
+
+    SUPPORTED_METHODS = ['GET', 'PUT']
+    upload = None
+
+    def upload_path(self, path):
+        """
+        This method map an url path to a file under ``upload_root`` and
+        refuse the paths with a hidden component or that leave the root,
+        through ``..`` or a symbolic link, and the existing directories.
+        """
+
+        target = files.resolve_path(options.upload_root, path)
+        if target is None:
+            raise tornado.web.HTTPError(403)
+        if os.path.isdir(target):
+            raise tornado.web.HTTPError(409, "%s is a directory" % path)
+        return target
+
+    def reply(self, status, offset, complete=False):
+        """
+        This method answer with the number of bytes received.
+        """
+
+        self.set_status(status)
+        self.set_header("Upload-Offset", offset)
+        self.finish({'offset': offset, 'complete': complete})
+
+    def prepare(self):
+        if self.request.method != 'PUT':
+            return
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        max_size = options.upload_max_size << 20
+        self.request.connection.set_max_body_size(max_size)
+        header = self.request.headers.get("Content-Range")
+        if header is None:
+            self.start, self.end, self.size = 0, None, None
+        else:
+            parsed = files.parse_content_range(header)
+            if parsed is None:
+                raise tornado.web.HTTPError(400, "invalid Content-Range")
+            self.start, self.end, self.size = parsed
+            if self.size > max_size:
+                raise tornado.web.HTTPError(413)
+            length = self.request.headers.get("Content-Length")
+            if length is not None and int(length) != self.end - self.start:
+                raise tornado.web.HTTPError(400, "Content-Length does not"
+                                            " match Content-Range")
+        upload = files.Upload(self.upload_path(self.path_args[0]))
+        try:
+            upload.open(self.start, self.size)
+        except files.UploadConflict as e:
+            self.reply(409, e.offset)
+            return
+        self.upload = upload
+
+    def data_received(self, chunk):
+        self.upload.write(chunk)
+
+    @tornado.web.authenticated
+    def get(self, path):
+        upload = files.Upload(self.upload_path(path))
+        received = upload.received()
+        self.reply(200, received, received == 0 and
+                   os.path.isfile(upload.path))
+
+    def put(self, path):
+        upload = self.upload
+        if self.end is not None and upload.offset != self.end:
+            upload.close()
+            self.reply(400, upload.offset)
+            return
+        complete = self.end is None or self.end == self.size
+        if complete:
+            upload.commit()
+            logging.info("Uploaded %s (%d bytes)" % (upload.path,
+                                                     upload.offset))
+        else:
+            upload.close()
+        self.reply(201 if complete else 202, upload.offset, complete)
+
+    def on_finish(self):
+        if self.upload is not None:
+            self.upload.close()
+
+    def on_connection_close(self):
+        if self.upload is not None:
+            self.upload.close()
+
+
 class ServerFilesHandler(tornado.web.RequestHandler):
     """
     This class  define methods that process the contents of the files that
     recides within the server e.g video, images, documents e.t.c.
     """
 
-    SUPPORTED_METHODS = ['GET']
+    SUPPORTED_METHODS = ['GET', 'HEAD']
+    SENDFILE_BURST = 8 * 1024 * 1024
 
-    def get(self, path):
+    @tornado.gen.coroutine
+    def get(self, path, include_body=True):
         """
         GET method to list contents of directory or
-        write index page if index.html exists.
+        write index page if index.html exists. The path is resolved under
+        ``files_root``.
 
         Args:
             path: define a path to the files(url).
         """
 
-        for index in ['index.html', 'index.htm']:
-            index = os.path.join(path, index)
-            if os.path.exists(index):
-                with open(index, 'rb') as f:
-                    self.write(f.read())
-                    self.finish()
-                    return
-        html = self.generate_index(path)
+        target = files.resolve_path(options.files_root, path)
+        if target is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            stat = os.stat(target)
+        except OSError:
+            raise tornado.web.HTTPError(404)
+        if not S_ISDIR(stat.st_mode):
+            yield self.send_file(target, include_body, stat)
+            return
+        index = self.application.listings.find(target, ['index.html',
+                                                        'index.htm'])
+        if index:
+            yield self.send_file(os.path.join(target, index), include_body)
+            return
+        html = self.generate_index(target, path)
         self.write(html)
         self.finish()
 
-    def generate_index(self, path):
+    def head(self, path):
+        """
+        HEAD method to send the headers of a file without its contents.
+        """
+
+        return self.get(path, include_body=False)
+
+    @tornado.gen.coroutine
+    def send_file(self, path, include_body=True, stat=None):
+        """
+        This method stream a file to the client ``read_buffer`` bytes at a
+        time, waiting for every chunk to be flushed. It answers conditional
+        requests with 304 and ``Range`` requests with one or more ranges.
+        Small files are served from the file cache when it is enabled and
+        files from ``sendfile_min_size`` are sent with ``sendfile`` when
+        the connection allows it.
+
+        Args:
+            path: path of the file.
+            include_body: False to only send the headers.
+            stat: ``os.stat`` result of the file if it is known.
+        """
+
+        if stat is None:
+            stat = os.stat(path)
+        # the encoding of the file is chosen here, not by GZipTransform
+        self.request.encoding_negotiated = True
+        original = path
+        path, stat, encoding, cached = self.select_representation(path, stat)
+        if cached is not None:
+            size = len(cached.body)
+            tag, content_type = cached.etag, cached.content_type
+        else:
+            size = stat.st_size
+            tag = files.etag(stat)
+            mime_type, ignored = mimetypes.guess_type(original)
+            content_type = mime_type or 'text/plain'
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+        self.set_header("Etag", tag)
+        self.set_header("Last-Modified",
+                        datetime.datetime.utcfromtimestamp(stat.st_mtime))
+        self.set_header("Accept-Ranges", "bytes")
+        if files.not_modified(self.request.headers, tag, stat.st_mtime):
+            self.set_status(304)
+            self.finish()
+            return
+
+        ranges = None
+        if ("Range" in self.request.headers and
+                files.if_range(self.request.headers, tag, stat.st_mtime)):
+            try:
+                ranges = files.parse_range(self.request.headers["Range"],
+                                           size)
+            except files.RangeNotSatisfiable:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+                self.finish()
+                return
+
+        trailer = ""
+        if not ranges:
+            parts = [("", 0, size)]
+            self.set_header("Content-Type", content_type)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            parts = [("", start, end)]
+            self.set_status(206)
+            self.set_header("Content-Type", content_type)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, end - 1, size))
+        else:
+            boundary, parts, trailer = files.multipart_ranges(
+                    ranges, size, content_type)
+            self.set_status(206)
+            self.set_header("Content-Type",
+                            "multipart/byteranges; boundary=%s" % boundary)
+        self.set_header("Content-Length",
+                        sum(len(header) + end - start
+                            for header, start, end in parts) + len(trailer))
+        if not include_body:
+            self.finish()
+            return
+
+        if cached is not None:
+            for header, start, end in parts:
+                self.write(header + cached.body[start:end])
+            self.finish(trailer)
+            return
+        zero_copy = (options.sendfile_min_size and
+                     stat.st_size >= options.sendfile_min_size * 1024 and
+                     self.can_sendfile())
+        with open(path, 'rb') as f:
+            for header, start, end in parts:
+                if header:
+                    self.write(header)
+                if zero_copy:
+                    yield self.flush()
+                    yield self.sendfile(f, start, end)
+                    continue
+                for chunk in files.read_chunks(f, start, end,
+                                               options.read_buffer):
+                    self.write(chunk)
+                    yield self.flush()
+        if trailer:
+            self.write(trailer)
+        self.finish()
+
+    def can_sendfile(self):
+        """
+        This method check whether the body can be written to the socket
+        with ``sendfile``, which needs the module and a plain HTTP/1
+        connection since TLS encrypts the bytes in user space. The bytes
+        sent around the connection are accounted in a private counter of
+        ``HTTP1Connection`` (tornado 4.4), without it the body is read in
+        python.
+        """
+
+        connection = self.request.connection
+        stream = getattr(connection, "stream", None)
+        return (files.sendfile is not None and stream is not None and
+                not isinstance(stream, tornado.iostream.SSLIOStream) and
+                isinstance(connection,
+                           tornado.http1connection.HTTP1Connection) and
+                hasattr(connection, "_expected_content_remaining"))
+
+    @tornado.gen.coroutine
+    def sendfile(self, f, start, end):
+        """
+        This method let the kernel copy the bytes ``start`` to ``end`` of a
+        file from the page cache to the socket. The headers must have been
+        flushed. A duplicate of the socket is watched by the IOLoop so the
+        IOStream keeps its own registration, and at most ``SENDFILE_BURST``
+        bytes are sent per writable event not to starve the other clients.
+
+        Args:
+            f: file opened in binary mode.
+            start: first byte.
+            end: byte after the last one.
+        """
+
+        connection = self.request.connection
+        io_loop = tornado.ioloop.IOLoop.current()
+        fd = os.dup(connection.stream.socket.fileno())
+        done = tornado.concurrent.Future()
+        position = [start]
+
+        def close(error=None):
+            io_loop.remove_handler(fd)
+            os.close(fd)
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+        def on_writable(fd, events):
+            burst = position[0] + self.SENDFILE_BURST
+            try:
+                while position[0] < min(end, burst):
+                    sent = files.sendfile(fd, f.fileno(), position[0],
+                                          min(end, burst) - position[0])
+                    if not sent:
+                        close(IOError("%s was truncated" % f.name))
+                        return
+                    position[0] += sent
+            except (IOError, OSError), e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                close(tornado.iostream.StreamClosedError(real_error=e))
+                return
+            if position[0] >= end:
+                close()
+
+        io_loop.add_handler(fd, on_writable, io_loop.WRITE | io_loop.ERROR)
+        try:
+            yield done
+        except Exception:
+            connection.stream.close()
+            raise
+        # the bytes went around HTTP1Connection, which counts them against
+        # the Content-Length in this private field as of tornado 4.4, its
+        # presence is checked by can_sendfile
+        connection._expected_content_remaining -= end - start
+
+    def select_representation(self, path, stat):
+        """
+        This method choose what to send for a file: a precompressed ``.br``
+        or ``.gz`` sibling that is not older than the file, a copy from the
+        gzip cache, or the file itself, according to ``Accept-Encoding``.
+        Range requests are not compressed on the fly.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+
+        Returns:
+            (path, stat, encoding, cached) of the representation, ``cached``
+            is a ``files.CachedFile`` or ``None``.
+        """
+
+        accepted = files.accepted_encodings(
+                self.request.headers.get("Accept-Encoding", ""))
+        for encoding, suffix in files.PRECOMPRESSED:
+            if encoding in accepted:
+                try:
+                    sibling_stat = os.stat(path + suffix)
+                except OSError:
+                    continue
+                if sibling_stat.st_mtime >= stat.st_mtime:
+                    return path + suffix, sibling_stat, encoding, None
+        gzip_cache = self.application.gzip_cache
+        if ("gzip" in accepted and gzip_cache is not None and
+                "Range" not in self.request.headers and
+                gzip_cache.cacheable(path, stat)):
+            cached = gzip_cache.lookup(path, stat)
+            if cached is not None:
+                return path, stat, "gzip", cached
+            self.compress(path, stat)
+        cached = None
+        if self.application.file_cache is not None:
+            cached = self.application.file_cache.get(path, stat)
+        return path, stat, None, cached
+
+    def compress(self, path, stat):
+        """
+        This method compress a file into the gzip cache on the worker pool,
+        the file is sent as it is until the compressed copy is ready.
+
+        Args:
+            path: path of the file.
+            stat: ``os.stat`` result of the file.
+        """
+
+        gzip_cache = self.application.gzip_cache
+        workers = self.application.workers
+        if path in gzip_cache.pending or workers.saturated():
+            return
+        future = workers.submit(gzip_cache.read, path, stat)
+        gzip_cache.pending.add(path)
+
+        def done(future):
+            gzip_cache.pending.discard(path)
+            try:
+                cached = future.result()
+            except (IOError, OSError) as e:
+                logging.warning("Unable to compress %s: %s" % (path, e))
+                return
+            if cached is not None:
+                gzip_cache.add(path, cached)
+
+        tornado.ioloop.IOLoop.current().add_future(future, done)
+
+    def generate_index(self, directory, path):
         """
         This method generate the  index.html for files and their proper mime
-        types.
+        types, or a json listing with ``?format=json``. The listing is sorted
+        with ``?sort=name|size|mtime&order=asc|desc`` and split in pages
+        with ``?page=N&per_page=N``. Hidden entries are not listed.
 
         Args:
+            directory: directory to list.
             path: url path for the files.
         """
 
-        if os.path.isdir(path):
-            files = os.listdir(path)
-        else:
-            files = [path]
-            mime_type, encoding = mimetypes.guess_type(path)
-            self.set_header("Content-Type", mime_type or 'text/plain')
-        files = [ path + '/' + filename + '/'
-                if os.path.isdir(os.path.join(path, filename))
-                else filename
-                for filename in files]
-        html_template = """
+        sort = self.get_argument("sort", "name")
+        order = self.get_argument("order", "asc")
+        if sort not in files.DirectoryCache.SORT_KEYS or \
+                order not in ("asc", "desc"):
+            raise tornado.web.HTTPError(400)
+        try:
+            page = max(1, int(self.get_argument("page", 1)))
+            per_page = max(1, int(self.get_argument(
+                    "per_page", options.listing_page_size)))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        entries = [(name, is_dir) for name, is_dir in
+                   self.application.listings.listing(directory, sort,
+                                                     order == "desc")
+                   if not name.startswith(".")]
+        pages = max(1, (len(entries) + per_page - 1) / per_page)
+        page = min(page, pages)
+        entries = entries[(page - 1) * per_page:page * per_page]
+        base = "/" + path.strip("/") + "/" if path.strip("/") else "/"
+        links = [(urllib.quote((base + name).encode("utf-8")) +
+                  ("/" if is_dir else ""), name + ("/" if is_dir else ""))
+                 for name, is_dir in entries]
+
+        if self.get_argument("format", None) == "json":
+            self.set_header("Content-Type", "application/json")
+            listing = []
+            for (name, is_dir), (href, text) in zip(entries, links):
+                size, mtime = files.stat_entry(directory, name)
+                listing.append({'name': name, 'href': href, 'dir': is_dir,
+                                'size': size, 'mtime': mtime})
+            return json.dumps({'path': base, 'page': page, 'pages': pages,
+                               'per_page': per_page, 'entries': listing})
+
+        def page_url(number):
+            return "?" + urllib.urlencode({'sort': sort, 'order': order,
+                                           'page': number,
+                                           'per_page': per_page})
+
+        return LISTING_TEMPLATE.generate(files=links, path=path, page=page,
+                                         pages=pages, page_url=page_url)
+
+
+LISTING_TEMPLATE = tornado.template.Template("""
         <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN"><html>
         <title>Directory listing for /{{ path }}</title>
         <body>
         <h2>Directory listing for /{{ path }}</h2>
         <hr>
         <ul>
-        {% for filename in files %}
-        <li><a href="{{ filename }}">{{ filename }}</a>
+        {% for href, filename in files %}
+        <li><a href="{{ href }}">{{ filename }}</a>
         {% end %}
         </ul>
+        {% if pages > 1 %}
+        <p>
+        {% if page > 1 %}<a href="{{ page_url(page - 1) }}">previous</a>{% end %}
+        page {{ page }} of {{ pages }}
+        {% if page < pages %}<a href="{{ page_url(page + 1) }}">next</a>{% end %}
+        </p>
+        {% end %}
         <hr>
         </body>
         </html>
-        """
-        t = tornado.template.Template(html_template)
-        return t.generate(files=files, path=path)
+        """)
 
 
 def main():
@@ -414,16 +1357,76 @@ def main():
     """
 
     tornado.options.parse_command_line()
-    opencv.Image().delete()
-    logging.info("Images deleted")
-    opencv.Label().delete()
-    logging.info("Labels deleted")
-    opencv.load_images_to_db("data/images")
+    if options.precompress:
+        written = files.precompress(options.precompress)
+        logging.info("Wrote %d compressed files" % written)
+        return
+    if options.recognizer == "lbph" and options.predict_engine != "opencv":
+        sys.exit("--predict-engine %s needs the subspace of --recognizer "
+                 "fisher, use --predict-engine opencv with lbph" %
+                 options.predict_engine)
+    for name in ("facedetector_scale", "predict_scale"):
+        if not 0 < options[name] <= 1:
+            sys.exit("--%s must be greater than 0 and at most 1" %
+                     name.replace("_", "-"))
+    opencv.PREDICT_ENGINE = options.predict_engine
+    opencv.INDEX_CANDIDATES = options.index_candidates
+    opencv.RECOGNIZER = options.recognizer
+    opencv.TRACK_FULL_EVERY = options.track_full_every
+    opencv.IDENTITY_MAX_FRAMES = options.identity_max_frames
+    opencv.IDENTITY_MAX_DISTANCE = options.identity_max_distance
+    opencv.HARVEST_CANDIDATES = options.harvest_candidates
+    opencv.batcher.max_delay = options.batch_delay / 1000.0
+    opencv.DETECTOR = options.detector
+    opencv.detectors.load()
+    logging.info("Face detectors loaded")
+    if options.rebuild:
+        opencv.Image.delete().execute()
+        logging.info("Images deleted")
+        opencv.Label.delete().execute()
+        opencv.label_index.invalidate()
+        logging.info("Labels deleted")
+    opencv.create_indexes()
+    added, removed = opencv.load_images_to_db("data/images")
     logging.info("Labels and images loaded")
-    opencv.train()
-    logging.info("Model trained")
+    training = opencv.last_training()
+    trained = (os.path.exists(opencv.MODEL_FILE) and training is not None
+               and training['recognizer'] == opencv.RECOGNIZER)
+    # images harvested since the last training are not in the model yet
+    behind = trained and opencv.latest_image() > training['last_image']
+    if options.rebuild:
+        opencv.train(full=True)
+        logging.info("Model trained")
+    elif trained and options.predict_engine == "numpy":
+        opencv.models.engine()
+        logging.info("Model loaded")
+    elif trained and options.predict_engine == "index":
+        opencv.models.index()
+        logging.info("Model loaded")
+    elif trained:
+        opencv.models.get()
+        logging.info("Model loaded")
+    sockets = None
+    if not options.reuse_port:
+        sockets = tornado.netutil.bind_sockets(options.port)
+    task_id = None
+    if options.processes != 1:
+        # the children open their own database connections
+        opencv.db.close()
+        task_id = tornado.process.fork_processes(options.processes)
+    if options.reuse_port:
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
     app = Application()
-    app.listen(options.port)
+    http_server = tornado.httpserver.HTTPServer(app)
+    http_server.add_sockets(sockets)
+    if task_id is not None:
+        tornado.ioloop.PeriodicCallback(app.reload_model,
+                                        options.model_poll * 1000).start()
+    if (not options.rebuild and (added or removed or behind or not trained)
+            and not task_id):
+        logging.info("Training the model in the background")
+        tornado.ioloop.IOLoop.current().spawn_callback(
+                app.train, full=bool(removed) or not trained)
     # http_server = tornado.httpserver.HTTPServer(app, ssl_options=ssl_ctx)
     # http_server.listen(options.port, address=options.listen_address)
     tornado.ioloop.IOLoop.instance().start()